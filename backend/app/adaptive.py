@@ -0,0 +1,221 @@
+"""
+Adaptive question ordering.
+
+Instead of following the hand-authored order of the rule tree, the adaptive
+mode asks, at each step, the question with the highest expected information
+gain about which leaf (diagnostic) of the tree applies. Every leaf is
+described by the answers on its path; its prior is the product of the prior
+probabilities of those answers, taken from the Bayesian network for the
+questions that feed it evidence and 0.5 for the others. The choice of
+question for every reachable set of answers is precomputed into a table, so
+serving a turn is a dict lookup.
+"""
+import math
+import os
+from collections import namedtuple
+
+from app.decision_graph import GraphEngine
+
+
+ANSWERS = ('yes', 'no')
+NO_MORE_QUESTIONS = "There are no more questions."
+
+# `answers` maps the fact of every question asked on the way to the leaf to its answer
+Leaf = namedtuple('Leaf', ['message', 'answers'])
+
+
+def enumerate_leaves(graph, entry):
+    """
+    Returns the leaves below the symptom fact `entry`, in the tree's own
+    order, by answering every question yes and no on a GraphEngine.
+    """
+    leaves = []
+
+    def walk(engine, answers):
+        questions = engine.get_questions()
+        if not questions:
+            leaves.append(Leaf(NO_MORE_QUESTIONS, answers))
+            return
+        message = questions[0]
+        fact = graph.expected_facts.get(message)
+        if fact is None or fact in answers:
+            leaves.append(Leaf(message, answers))
+            return
+        for answer in ANSWERS:
+            branch = GraphEngine(graph)
+            branch.facts = set(engine.facts)
+            branch.questions = questions[1:]
+            branch.assert_fact(fact, answer)
+            walk(branch, dict(answers, **{fact: answer}))
+
+    engine = GraphEngine(graph)
+    engine.assert_fact(*entry)
+    walk(engine, {})
+    return leaves
+
+
+def _entropy(weights):
+    total = sum(weights)
+    return -sum(w / total * math.log2(w / total) for w in weights if w > 0)
+
+
+class QuestionPolicy:
+    """
+    Precomputed adaptive policy: for every symptom fact and every set of
+    answers reachable from it, the next question or the final message.
+    """
+
+    def __init__(self, graph, entries, answer_prior, confidence=1.0):
+        """
+        `answer_prior(fact)` is the prior probability of answering 'yes' to
+        the question that declares `fact`. A leaf is concluded once every
+        answer on its path is known, or earlier when its posterior
+        probability reaches `confidence`.
+        """
+        self.confidence = confidence
+        self.expected_facts = graph.expected_facts
+        self._questions = {fact: question for question, fact in graph.expected_facts.items()}
+        self._answer_prior = answer_prior
+        self.tables = {}
+        for entry in entries:
+            leaves = enumerate_leaves(graph, entry)
+            # Facts in the order the tree asks them, to break ties like the tree does
+            order = {}
+            for leaf in leaves:
+                for fact in leaf.answers:
+                    order.setdefault(fact, len(order))
+            table = {}
+            self._fill(table, leaves, [self._prior(leaf) for leaf in leaves], {}, order)
+            self.tables[entry] = table
+
+    def _prior(self, leaf):
+        prior = 1.0
+        for fact, answer in leaf.answers.items():
+            p_yes = self._answer_prior(fact)
+            prior *= p_yes if answer == 'yes' else 1 - p_yes
+        return prior
+
+    def _answer_likelihood(self, leaf, fact, answer):
+        # A leaf whose path does not ask `fact` is reached with either answer
+        if fact not in leaf.answers:
+            p_yes = self._answer_prior(fact)
+            return p_yes if answer == 'yes' else 1 - p_yes
+        return 1.0 if leaf.answers[fact] == answer else 0.0
+
+    def _fill(self, table, leaves, weights, answers, order):
+        key = frozenset(answers.items())
+        for leaf in leaves:
+            if all(answers.get(fact) == answer for fact, answer in leaf.answers.items()):
+                table[key] = leaf.message
+                return
+        total = sum(weights)
+        likeliest = max(range(len(leaves)), key=weights.__getitem__)
+        if weights[likeliest] / total >= self.confidence:
+            table[key] = leaves[likeliest].message
+            return
+
+        best = None
+        entropy = _entropy(weights)
+        for fact in sorted({fact for leaf in leaves for fact in leaf.answers if fact not in answers},
+                           key=order.__getitem__):
+            expected = 0.0
+            for answer in ANSWERS:
+                branch = [w * self._answer_likelihood(leaf, fact, answer) for leaf, w in zip(leaves, weights)]
+                mass = sum(branch)
+                if mass > 0:
+                    expected += mass / total * _entropy(branch)
+            gain = entropy - expected
+            if best is None or gain > best[0] + 1e-12:
+                best = (gain, fact)
+
+        fact = best[1]
+        table[key] = self._questions[fact]
+        for answer in ANSWERS:
+            branch = [(leaf, w * self._answer_likelihood(leaf, fact, answer)) for leaf, w in zip(leaves, weights)]
+            branch = [(leaf, w) for leaf, w in branch if w > 0]
+            if branch:
+                self._fill(table, [leaf for leaf, _ in branch], [w for _, w in branch],
+                           dict(answers, **{fact: answer}), order)
+
+    def next_message(self, entry, answers):
+        """
+        Returns the question to ask or the final message, or None when the
+        answers lead nowhere in the tree.
+        """
+        table = self.tables.get(entry)
+        return table.get(frozenset(answers.items())) if table is not None else None
+
+
+def build_policy(knowledge_base, confidence=None):
+    """
+    Builds the QuestionPolicy of a KnowledgeBase. Questions that feed evidence
+    to the Bayesian network get the marginal probability of the state a 'yes'
+    answer is recorded as (1), the others 0.5. `confidence` defaults to
+    ADAPTIVE_CONFIDENCE, or 1.0 to only conclude the leaf the tree would.
+    """
+    if confidence is None:
+        confidence = float(os.environ.get('ADAPTIVE_CONFIDENCE', '1.0'))
+    from app.chatbot import QUESTION_VARIABLES
+
+    fact_variables = {knowledge_base.graph.expected_facts[question]: variable
+                      for question, variable in QUESTION_VARIABLES.items()
+                      if question in knowledge_base.graph.expected_facts}
+    marginals = {}
+
+    def answer_prior(fact):
+        variable = fact_variables.get(fact)
+        if variable is None:
+            return 0.5
+        if variable not in marginals:
+            marginals[variable] = knowledge_base.inference.query(variable, {})[1]
+        return marginals[variable]
+
+    return QuestionPolicy(knowledge_base.graph, sorted(set(knowledge_base.symptom_facts.values())), answer_prior,
+                          confidence)
+
+
+class AdaptiveEngine:
+    """
+    Serves conversation turns from a QuestionPolicy with the interface the
+    chatbot uses on its other engines.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.expected_facts = policy.expected_facts
+        self.questions = []
+        self.entry = None
+        self.answers = {}
+
+    def get_questions(self):
+        return self.questions
+
+    def clear_questions(self):
+        self.questions.clear()
+
+    def reset(self):
+        self.entry = None
+        self.answers = {}
+
+    def assert_fact(self, fact, value):
+        # The first fact after a reset is the symptom, the rest are answers. Like facts that fire no
+        # rule on the other engines, values other than yes/no are ignored and the question stays open
+        if self.entry is None:
+            self.entry = (fact, value)
+        elif fact in self.answers or value not in ANSWERS:
+            return
+        else:
+            self.answers[fact] = value
+        message = self.policy.next_message(self.entry, self.answers)
+        # Like the other engines, a dead end leaves the queue empty
+        if message is not None and message != NO_MORE_QUESTIONS:
+            self.questions.append(message)
+
+    def known_facts(self):
+        return ([list(self.entry)] if self.entry else []) + [[fact, value] for fact, value in self.answers.items()]
+
+    def restore_facts(self, facts):
+        self.reset()
+        if facts:
+            self.entry = tuple(facts[0])
+            self.answers = {fact: value for fact, value in facts[1:]}
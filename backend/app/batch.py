@@ -0,0 +1,88 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def extract_diagnostic(response):
+    """
+    Returns the 'Diagnostic: ...' line of a bot response, or None.
+    """
+    start = response.find("Diagnostic:")
+    if start == -1:
+        return None
+    end = response.find("\n", start)
+    return response[start:] if end == -1 else response[start:end]
+
+
+def replay_conversation(messages):
+    """
+    Runs one conversation on a fresh chatbot and returns every reply and the last diagnostic.
+    """
+    from app.chatbot import CarTroubleshootingChatbot
+
+    chatbot = CarTroubleshootingChatbot()
+    responses = []
+    diagnostic = None
+    try:
+        for message in messages:
+            response = chatbot.diagnose(message)
+            responses.append(response)
+            diagnostic = extract_diagnostic(response) or diagnostic
+    finally:
+        chatbot.release()
+    return {"responses": responses, "diagnostic": diagnostic}
+
+
+def replay_chunk(start, conversations):
+    # One task per chunk keeps the inter-process overhead per conversation low
+    return [dict(replay_conversation(messages), index=start + offset)
+            for offset, messages in enumerate(conversations)]
+
+
+class BatchReplayer:
+    """
+    Replays many independent conversations in parallel, each in its own chatbot.
+
+    With `workers > 0` chunks run on a process pool (started lazily with the
+    'spawn' method, so it is safe next to the server's threads); with
+    `workers == 0` they run on a single background thread.
+    """
+
+    def __init__(self, workers=0, chunk_size=64):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-replay")
+        return self._executor
+
+    def _submit_chunks(self, conversations):
+        executor = self._get_executor()
+        return [asyncio.wrap_future(executor.submit(replay_chunk, start, conversations[start:start + self.chunk_size]))
+                for start in range(0, len(conversations), self.chunk_size)]
+
+    async def replay(self, conversations):
+        """
+        Returns the results of every conversation, in request order.
+        """
+        chunks = await asyncio.gather(*self._submit_chunks(conversations))
+        return [result for chunk in chunks for result in chunk]
+
+    async def replay_as_completed(self, conversations):
+        """
+        Yields results chunk by chunk as they finish; each carries its `index`.
+        """
+        for chunk in asyncio.as_completed(self._submit_chunks(conversations)):
+            for result in await chunk:
+                yield result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
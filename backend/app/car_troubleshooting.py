@@ -1,12 +1,13 @@
-import json
 from experta import *
-from pgmpy.models import BayesianNetwork
-from pgmpy.factors.discrete import TabularCPD
-from pgmpy.inference import VariableElimination
-import re
+# The chatbot lives in app.chatbot, which needs neither experta nor pgmpy in 'graph' mode
+from app.chatbot import (ANSWER_MATCHER, ANSWERS, ENGINE_MODES, GENERIC_RESPONSE_MATCHER, GENERIC_RESPONSES,
+                         QUESTION_VARIABLES, SYMPTOM_FACTS, SYMPTOMS, CarTroubleshootingChatbot)
 
 
 def create_bayesian_network():
+    from pgmpy.models import BayesianNetwork
+    from pgmpy.factors.discrete import TabularCPD
+
     # Define the structure of the network
     model = BayesianNetwork([
         ('Battery', 'NoStart'),
@@ -73,289 +74,14 @@ def create_bayesian_network():
 
     return model
 
-class CarTroubleshootingChatbot:
-    def __init__(self):
-        self.engine = CarTroubleshootingSystem()
-        self.engine.reset()
-        self.bayesian_network = create_bayesian_network()
-        self.inference = VariableElimination(self.bayesian_network)
-        self.current_question = None
-        self.evidence = {}
-        self.conversation_log = [] 
-        
-    def update_probabilities(self, symptom, value):
-        # Complete mapping of questions to variables
-        symptom_mapping = {
-            'Do the Starter spins?': 'Battery',
-            'Do the battery read over 12V?': 'Battery',
-            'Are the terminals clean?': 'Battery',
-            'Spark from coil?': 'Ignition',
-            'Check Engine Light On?': 'CheckEngineLight',
-            'Do the brakes feel spongy?': 'BrakeSystem',
-            'Is the brake pedal firm?': 'BrakePedal',
-            'Is there an electrical failure?': 'ElectricalSystem',
-            'Was the Alternator tested OK?': 'Alternator'
-        }
-        
-        # Get the corresponding variable
-        bayesian_var = symptom_mapping.get(symptom)
-        if bayesian_var:
-            self.evidence[symptom] = int(value == 'yes')
-            
-            if bayesian_var == 'Battery':
-                problems = self._count_battery_problems()
-                self.evidence['Battery'] = 1 if problems >= 2 else 0
-            elif bayesian_var in ['BrakeSystem', 'BrakePedal']:
-                problems = self._count_brake_problems()
-                self.evidence['BrakeFailure'] = 1 if problems >= 1 else 0
-            elif bayesian_var in ['ElectricalSystem', 'Alternator']:
-                problems = self._count_electrical_problems()
-                self.evidence['ElectricalFailure'] = 1 if problems >= 1 else 0
-            
-            try:
-                prob_failure = self._calculate_system_probability(bayesian_var)
-                return prob_failure, bayesian_var
-                    
-            except Exception as e:
-                return None, None
-        
-        return None, None
-
-    def _count_battery_problems(self):
-            problems = 0
-            if 'Do the Starter spins?' in self.evidence and self.evidence['Do the Starter spins?'] == 0:
-                problems += 1
-            if 'Do the battery read over 12V?' in self.evidence and self.evidence['Do the battery read over 12V?'] == 0:
-                problems += 1
-            if 'Are the terminals clean?' in self.evidence and self.evidence['Are the terminals clean?'] == 0:
-                problems += 1
-            return problems
-
-    def _count_brake_problems(self):
-        problems = 0
-        if 'Do the brakes feel spongy?' in self.evidence and self.evidence['Do the brakes feel spongy?'] == 1:
-            problems += 1
-        if 'Is the brake pedal firm?' in self.evidence and self.evidence['Is the brake pedal firm?'] == 0:
-            problems += 1
-        return problems
-
-    def _count_steering_problems(self):
-        problems = 0
-        if 'Is the steering loose?' in self.evidence and self.evidence['Is the steering loose?'] == 1:
-            problems += 1
-        if 'Is the power steering working?' in self.evidence and self.evidence['Is the power steering working?'] == 0:
-            problems += 1
-        return problems
-
-    def _count_electrical_problems(self):
-        problems = 0
-        if 'Is there an electrical failure?' in self.evidence and self.evidence['Is there an electrical failure?'] == 1:
-            problems += 1
-        if 'Was the Alternator tested OK?' in self.evidence and self.evidence['Was the Alternator tested OK?'] == 0:
-            problems += 1
-        return problems
-
-    def _calculate_system_probability(self, bayesian_var):
-        # Create a dictionary of evidence only with the variables of the Bayesian network
-        bayesian_evidence = {}
-        
-        if bayesian_var in ['Battery', 'Ignition']:
-            bayesian_evidence['Battery'] = self.evidence.get('Battery', 0)
-            query_result = self.inference.query(['NoStart'], evidence=bayesian_evidence)
-            prob_values = query_result.values
-            prob_failure = float(prob_values[1])
-            problems = self._count_battery_problems()
-            
-        elif bayesian_var in ['BrakeSystem', 'BrakePedal']:
-            bayesian_evidence['BrakeFailure'] = self.evidence.get('BrakeFailure', 0)
-            query_result = self.inference.query(['BrakeFailure'], evidence=bayesian_evidence)
-            prob_values = query_result.values
-            prob_failure = float(prob_values[1])
-            problems = self._count_brake_problems()
-            
-        elif bayesian_var in ['ElectricalSystem', 'Alternator']:
-            query_result = self.inference.query(['ElectricalFailure'], evidence=self.evidence)
-            prob_values = query_result.values
-            prob_failure = float(prob_values[1])
-            problems = self._count_electrical_problems()
-        
-        # Adjust the probability based on the number of problems
-        if problems == 1:
-            prob_failure = (prob_failure + 0.3) / 2
-        elif problems >= 2:
-            prob_failure = (prob_failure + 0.7) / 2
-            
-        return prob_failure
-
-    def diagnose(self, message):
-    # Normalize and clean the input message
-        message = message.lower()
-        message = re.sub(r'[^\w\s]', '', message)
-
-        # Define known symptoms and corresponding keywords
-        symptoms = {
-            # Starter-related issues
-            'no_start': ["not starting", "no start", "wont start", "won't start", "doesn't start", "does not start", "car won't turn on"],
-            'car_stall': ["car stall", "car start and stall", "car stops", "the car starts and then stalls"],
-            # Unusual noise
-            'unusual_noise': ["unusual noise", "strange noise", "weird sound", "clicking noise", "knocking noise", "noise in car"],
-            'tick_noise': ["tick noise", "unusual tick noises", "ticks on engine", "ticks", "tick when moving"],
-            # Overheating and leaks
-            'streaming': ["streaming", "stream", "smoking", "stream from engine"],
-            'leaking': ["leaking", "leak", "dropping"],
-            # Brakes and electrical systems
-            'brakes_problem': ["brakes problems", "brakes", "brake", "dont have brakes", "car doesn't stop"],
-            'electric_problems': ["electric problems", "electric problem", "electric", "electronic", "wire problems"]
-        }
-
-        # Check if the message matches a known symptom
-        for symptom, phrases in symptoms.items():
-            for phrase in phrases:
-                if phrase in message:
-                    # Handle symptom-specific logic
-                    if symptom == 'no_start':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(starter_cranks='no'))
-                        self.evidence = {}
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'car_stall':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(starter_cranks='yes'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'unusual_noise':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(clunk_or_singletick='yes'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'tick_noise':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(clunk_or_singletick='no'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'streaming':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(streaming_or_leak='yes'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'leaking':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(streaming_or_leak='no'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'brakes_problem':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(brakes_failure='yes'))
-                        self.engine.run()
-                        return self.process_questions()
-                    if symptom == 'electric_problems':
-                        self.engine.reset()
-                        self.engine.declare(CarDiagnosis(electric_problem='yes'))
-                        self.engine.run()
-                        return self.process_questions()
-
-        # Process the message as an answer to the current question
-        if self.current_question:
-            prob, bayesian_var = self.update_probabilities(self.current_question, message)
-
-            # Declare the fact based on the current response
-            expected_fact = self.engine.expected_facts.get(self.current_question)
-            if expected_fact:
-                self.engine.declare(CarDiagnosis(**{expected_fact: message}))
-                self.engine.run()
-
-            next_question = self.process_questions()
-            probability_message = ""
-
-            if prob:
-                # Map Bayesian variables to system names
-                system_names = {
-                    'Battery': 'Battery System',
-                    'Ignition': 'Ignition System',
-                    'BrakeSystem': 'Brake System',
-                    'BrakePedal': 'Brake System',
-                    'ElectricalSystem': 'Electrical System',
-                    'Alternator': 'Electrical System'
-                }
-                system_name = system_names.get(bayesian_var, 'System')
-
-                if prob > 0.7:
-                    probability_message = f"High probability ({prob:.2f}) of failure in the {system_name}. Immediate inspection recommended.\n"
-                elif prob > 0.5:
-                    probability_message = f"Moderate to high probability ({prob:.2f}) of failure in the {system_name}.\n"
-                elif prob > 0.3:
-                    probability_message = f"Some indicators of possible failure ({prob:.2f}) in the {system_name}.\n"
-
-            if "Diagnostic:" in next_question:
-                self.current_question = None
-                self.evidence = {}
-                return f"{probability_message} {next_question}\nDiagnosis completed. Is there any other issue you'd like to discuss?"
-            else:
-                return f"{probability_message} {next_question}"
-
-        # Handle generic responses
-        responds = {
-            'no': ["no", "nooo", "negative", "maybe not", "it not", "nn", "nah", "nope", "n"],
-            'yes': ["yes", "affirmative", "obscurse", "yy", "yesy", "yup", "yeah", "yep", "y"]
-        }
-
-        for respond, phrases in responds.items():
-            for phrase in phrases:
-                if phrase in message:
-                    return self.respond_to_input(message)
-
-        # If no valid symptom or answer was detected
-        return "Sorry, I don't understand the problem. Could you describe the symptom in another way?"
-
-
-    def process_questions(self):
-        """
-        Retrieves the next question from the list of questions generated by the engine.
-        """
-        questions = self.engine.get_questions()
-        if questions:
-            self.current_question = questions[0]
-            return questions.pop(0)
-        return "There are no more questions."
-
-    def respond_to_input(self, message):
-        """
-        Processes the user's input as a response to the current question.
-        """
-        # If there is no current question, ask the user to describe the issue
-        if not self.current_question:
-            return "There are no pending questions. Please describe the problem you are experiencing with your vehicle."
-
-        # Define mappings for 'yes' and 'no' responses
-        responds = {
-            'no': ["no", "negative", "maybe not", "it not"],
-            'yes': ["yes", "affirmative", "of course", "yeah"]
-        }
-
-        # Determine if the response is 'yes' or 'no'
-        response = None
-        for answer, phrases in responds.items():
-            if any(phrase in message.lower() for phrase in phrases):
-                response = answer
-                break
-
-        if response:
-            # Update the rule engine with the response
-            expected_fact = self.engine.expected_facts.get(self.current_question)
-            if expected_fact:
-                self.engine.declare(CarDiagnosis(**{expected_fact: response}))
-                self.engine.run()
-                return self.process_questions()
-        
-        return "Please respond with 'yes' or 'no' to the question."
-
-
 
 class CarDiagnosis(Fact):
     pass
 
-class CarTroubleshootingSystem(KnowledgeEngine):
+class DiagnosisEngine(KnowledgeEngine):
+    """
+    Question bookkeeping shared by the rule engines; subclasses only add rules.
+    """
     def __init__(self):
         super().__init__()
         self.questions = []
@@ -367,6 +93,21 @@ class CarTroubleshootingSystem(KnowledgeEngine):
     def clear_questions(self):
         self.questions.clear()
 
+    def assert_fact(self, fact, value):
+        self.declare(CarDiagnosis(**{fact: value}))
+        self.run()
+
+    def known_facts(self):
+        return [next(iter(fact.as_dict().items())) for fact in self.facts.values() if isinstance(fact, CarDiagnosis)]
+
+    def restore_facts(self, facts):
+        # Replaying the facts in declaration order also rebuilds expected_facts;
+        # facts the rules declare again are deduplicated by the fact list
+        self.reset()
+        for fact, value in facts:
+            self.assert_fact(fact, value)
+
+class CarTroubleshootingSystem(DiagnosisEngine):
     # Start Problem
 
     @Rule(CarDiagnosis(start_problem='yes'))
@@ -0,0 +1,643 @@
+import os
+import re
+import sys
+from array import array
+from app.adaptive import AdaptiveEngine
+from app.decision_graph import GraphEngine
+from app.knowledge_base import find_knowledge_base, get_knowledge_base
+from app.matching import PhraseMatcher
+from app.metrics import timed_stage
+from app.opener_cache import Opener, opener_cache
+
+# 'experta' runs the rule engine on every turn, 'graph' serves turns from the compiled decision graph,
+# 'adaptive' asks the most informative question first (see app.adaptive)
+ENGINE_MODES = ('experta', 'graph', 'adaptive')
+
+# Known symptoms and corresponding keywords, in matching priority order
+SYMPTOMS = {
+    # Starter-related issues
+    'no_start': ["not starting", "no start", "wont start", "won't start", "doesn't start", "does not start", "car won't turn on"],
+    'car_stall': ["car stall", "car start and stall", "car stops", "the car starts and then stalls"],
+    # Unusual noise
+    'unusual_noise': ["unusual noise", "strange noise", "weird sound", "clicking noise", "knocking noise", "noise in car"],
+    'tick_noise': ["tick noise", "unusual tick noises", "ticks on engine", "ticks", "tick when moving"],
+    # Overheating and leaks
+    'streaming': ["streaming", "stream", "smoking", "stream from engine"],
+    'leaking': ["leaking", "leak", "dropping"],
+    # Brakes and electrical systems
+    'brakes_problem': ["brakes problems", "brakes", "brake", "dont have brakes", "car doesn't stop"],
+    'electric_problems': ["electric problems", "electric problem", "electric", "electronic", "wire problems"]
+}
+
+# Fact declared on the rule engine when a symptom opens a new diagnosis
+SYMPTOM_FACTS = {
+    'no_start': ('starter_cranks', 'no'),
+    'car_stall': ('starter_cranks', 'yes'),
+    'unusual_noise': ('clunk_or_singletick', 'yes'),
+    'tick_noise': ('clunk_or_singletick', 'no'),
+    'streaming': ('streaming_or_leak', 'yes'),
+    'leaking': ('streaming_or_leak', 'no'),
+    'brakes_problem': ('brakes_failure', 'yes'),
+    'electric_problems': ('electric_problem', 'yes'),
+}
+
+# Loose yes/no replies accepted when there is no pending question
+GENERIC_RESPONSES = {
+    'no': ["no", "nooo", "negative", "maybe not", "it not", "nn", "nah", "nope", "n"],
+    'yes': ["yes", "affirmative", "obscurse", "yy", "yesy", "yup", "yeah", "yep", "y"]
+}
+
+# Mappings for 'yes' and 'no' responses to a question
+ANSWERS = {
+    'no': ["no", "negative", "maybe not", "it not"],
+    'yes': ["yes", "affirmative", "of course", "yeah"]
+}
+
+GENERIC_RESPONSE_MATCHER = PhraseMatcher(GENERIC_RESPONSES)
+ANSWER_MATCHER = PhraseMatcher(ANSWERS)
+
+# Opens the first reply of a saved conversation that could not be resumed (see load_state())
+RESTARTED_NOTICE = "The troubleshooting guide was updated, so your previous conversation was restarted."
+
+
+# Complete mapping of questions to variables of the Bayesian network; a 'yes' is recorded as state 1
+QUESTION_VARIABLES = {
+    'Do the Starter spins?': 'Battery',
+    'Do the battery read over 12V?': 'Battery',
+    'Are the terminals clean?': 'Battery',
+    'Spark from coil?': 'Ignition',
+    'Check Engine Light On?': 'CheckEngineLight',
+    'Do the brakes feel spongy?': 'BrakeSystem',
+    'Is the brake pedal firm?': 'BrakePedal',
+    'Is there an electrical failure?': 'ElectricalSystem',
+    'Was the Alternator tested OK?': 'Alternator'
+}
+
+# Evidence is an array: one slot per question above, in order, then the network variables derived from them
+EVIDENCE_NAMES = tuple(QUESTION_VARIABLES) + ('Battery', 'BrakeFailure', 'ElectricalFailure')
+EVIDENCE_SLOTS = {name: slot for slot, name in enumerate(EVIDENCE_NAMES)}
+SLOT_VARIABLES = tuple(QUESTION_VARIABLES.values())
+BATTERY, BRAKE_FAILURE, ELECTRICAL_FAILURE = (EVIDENCE_SLOTS[name] for name in ('Battery', 'BrakeFailure', 'ElectricalFailure'))
+
+# (evidence slot, value) pairs that each count as one problem of a system
+BATTERY_PROBLEMS = tuple((EVIDENCE_SLOTS[question], 0) for question in
+                         ('Do the Starter spins?', 'Do the battery read over 12V?', 'Are the terminals clean?'))
+BRAKE_PROBLEMS = ((EVIDENCE_SLOTS['Do the brakes feel spongy?'], 1), (EVIDENCE_SLOTS['Is the brake pedal firm?'], 0))
+ELECTRICAL_PROBLEMS = ((EVIDENCE_SLOTS['Is there an electrical failure?'], 1),
+                       (EVIDENCE_SLOTS['Was the Alternator tested OK?'], 0))
+
+
+# Evidence vector of a conversation with no evidence, shared by all of them; 255 marks an unknown slot
+UNKNOWN = 255
+NO_EVIDENCE = bytes([UNKNOWN] * len(EVIDENCE_NAMES))
+
+
+def _pack(values):
+    # Registry ids as 2-byte integers; an empty tuple is shared, and anything else is kept as given
+    if not values:
+        return ()
+    if all(type(value) is int and 0 <= value < 65536 for value in values):
+        return array('H', values)
+    return tuple(values)
+
+
+class ConversationState:
+    """
+    Compact snapshot of a conversation between two turns, as kept by
+    CompactSessionStore: the knowledge base it runs on (shared), the pending
+    question id, the answered facts as registry ids in the order they were
+    learnt, the queued question ids and the evidence vector (one byte per
+    slot). Everything else is rebuilt on the next turn.
+    """
+
+    __slots__ = ('knowledge_base', 'question', 'facts', 'queued', 'evidence')
+
+    def __init__(self, knowledge_base, question, facts, queued, evidence):
+        self.knowledge_base = knowledge_base
+        self.question = question
+        self.facts = facts
+        self.queued = queued
+        self.evidence = evidence
+
+    def nbytes(self):
+        """
+        Approximate memory held by this conversation alone (the knowledge base and shared empty values excluded).
+        """
+        size = sys.getsizeof(self)
+        if self.question is not None:
+            size += sys.getsizeof(self.question)
+        for value in (self.facts, self.queued):
+            if value:
+                size += sys.getsizeof(value) + (sum(sys.getsizeof(item) for item in value)
+                                                 if isinstance(value, tuple) else 0)
+        if self.evidence is not NO_EVIDENCE:
+            size += sys.getsizeof(self.evidence)
+        return size
+
+
+class MachineState:
+    """
+    Snapshot of a conversation running on the knowledge base's state machine:
+    its node, which stands for the whole conversation state.
+    """
+
+    __slots__ = ('knowledge_base', 'node')
+
+    def __init__(self, knowledge_base, node):
+        self.knowledge_base = knowledge_base
+        self.node = node
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.node)
+
+
+class CarTroubleshootingChatbot:
+    def __init__(self, engine_mode=None, knowledge_base=None):
+        engine_mode = engine_mode or os.environ.get('CHATBOT_ENGINE', 'graph')
+        if engine_mode not in ENGINE_MODES:
+            raise ValueError(f"Unknown engine mode {engine_mode!r}, expected one of {ENGINE_MODES}")
+        self.engine_mode = engine_mode
+        # Without an explicit knowledge base, new conversations follow reloads
+        self.follow_reloads = knowledge_base is None
+        # Pool the rule engine was checked out of, until release()
+        self._engine_pool = None
+        # Shared read-only knowledge; everything else on the instance is conversation state
+        self.use_knowledge_base(knowledge_base or get_knowledge_base())
+        # Id of the pending question in the registry (its text if the registry does not know it)
+        self._question = None
+        self._evidence = [None] * len(EVIDENCE_NAMES)
+        # Node of the state machine while the conversation runs on it (see app.state_machine); the
+        # pending question is kept up to date meanwhile, the rule engine and evidence are not
+        self._node = 0 if self.state_machine is not None else None
+        # Set by load_state() when the saved conversation had to start over
+        self._restarted = False
+
+    def use_knowledge_base(self, knowledge_base):
+        """
+        Switches to another knowledge base version with a fresh rule engine.
+        """
+        self.release()
+        self.knowledge_base = knowledge_base
+        if self.engine_mode == 'experta':
+            # Rete networks are costly to build, so experta engines come built and reset from a pool
+            self._engine_pool = knowledge_base.engine_pool
+            self.engine = self._engine_pool.checkout()
+        else:
+            if self.engine_mode == 'graph':
+                self.engine = GraphEngine(knowledge_base.graph)
+            else:
+                self.engine = AdaptiveEngine(knowledge_base.policy)
+            self.engine.reset()
+        self.inference = knowledge_base.inference
+        self.registry = knowledge_base.registry
+        self.state_machine = knowledge_base.state_machine if self.engine_mode == 'graph' else None
+        self._node = None
+
+    def release(self):
+        """
+        Gives a pooled rule engine back once the conversation has been saved
+        elsewhere; the chatbot cannot run turns afterwards.
+        """
+        if self._engine_pool is not None:
+            self._engine_pool.checkin(self.engine)
+            self._engine_pool = None
+            self.engine = None
+
+    @property
+    def current_question(self):
+        # Question text is only rendered at the boundary; turns carry the id
+        return self.registry.decode_question(self._question)
+
+    @current_question.setter
+    def current_question(self, question):
+        self._leave_machine()
+        self._question = self.registry.encode_question(question)
+
+    @property
+    def evidence(self):
+        if self._node is not None:
+            evidence = self.state_machine.state(self._node)[3]
+            return {EVIDENCE_NAMES[slot]: value for slot, value in enumerate(evidence) if value != UNKNOWN}
+        return {EVIDENCE_NAMES[slot]: value for slot, value in enumerate(self._evidence) if value is not None}
+
+    @evidence.setter
+    def evidence(self, evidence):
+        self._leave_machine()
+        self._evidence = [evidence.get(name) for name in EVIDENCE_NAMES]
+
+    def _enter_machine(self):
+        # A conversation with nothing pending and no evidence is where a new one starts: the first node
+        if (self.state_machine is not None and self._question is None and not self.engine.get_questions()
+                and all(value is None for value in self._evidence)):
+            self._node = 0
+
+    def _leave_machine(self):
+        # Loads the state the node stands for into the rule engine, to go on without the machine
+        if self._node is not None:
+            question, facts, queued, evidence = self.state_machine.state(self._node)
+            self.engine.reset()
+            self.engine.clear_questions()
+            self._evidence = [None] * len(EVIDENCE_NAMES)
+            self.restore(ConversationState(self.knowledge_base, question, facts, queued, evidence))
+
+    def dump_state(self):
+        """
+        Returns the conversation state as compact JSON-compatible data, with
+        questions and facts as registry ids: the registry fingerprint, the
+        current question, the evidence as `slot * 2 + value`, the questions
+        still queued and the facts in the rule engine's working memory. The
+        digest of the knowledge-base file ("d") records the version the
+        conversation runs on. A conversation on the state machine also saves
+        its node, with the machine's digest ("n", "m"), and the state as the
+        node has it.
+        """
+        registry = self.registry
+        if self._node is not None:
+            question, facts, queued, evidence = self.state_machine.state(self._node)
+            state = {"k": registry.fingerprint, "q": question,
+                     "e": [slot * 2 + value for slot, value in enumerate(evidence) if value != UNKNOWN],
+                     "p": list(queued), "f": list(facts), "n": self._node, "m": self.state_machine.digest.hex()}
+        else:
+            state = {"k": registry.fingerprint, "q": self._question,
+                     "e": [slot * 2 + value for slot, value in enumerate(self._evidence) if value is not None],
+                     "p": [registry.encode_question(question) for question in self.engine.get_questions()],
+                     "f": [registry.encode_fact(fact, value) for fact, value in self.engine.known_facts()]}
+        if self.knowledge_base.digest is not None:
+            state["d"] = self.knowledge_base.digest
+        return state
+
+    def load_state(self, state):
+        """
+        Restores a state returned by dump_state() into a fresh chatbot, on the
+        knowledge base version it was saved on while this process still keeps
+        it (see find_knowledge_base()). States saved before ids were used
+        (texts throughout) are read too. A state whose version is gone, or
+        whose ids are from a knowledge base with other questions or facts,
+        cannot be: the conversation starts over and its next reply says so.
+        """
+        digest = state.get("d")
+        if digest is not None and digest != self.knowledge_base.digest:
+            knowledge_base = find_knowledge_base(digest)
+            if knowledge_base is None:
+                self._restarted = True
+                return
+            self.use_knowledge_base(knowledge_base)
+        registry = self.registry
+        if state.get("k", registry.fingerprint) != registry.fingerprint:
+            self._restarted = True
+            return
+        self.engine.restore_facts([registry.decode_fact(fact) for fact in state["f"]])
+        self.engine.clear_questions()
+        self.engine.get_questions().extend(registry.decode_question(question) for question in state["p"])
+        self._question = registry.encode_question(state["q"])
+        if isinstance(state["e"], dict):
+            self.evidence = state["e"]
+        else:
+            self._evidence = [None] * len(EVIDENCE_NAMES)
+            for entry in state["e"]:
+                self._evidence[entry >> 1] = entry & 1
+        self._node = None
+        # Saved on the same state machine: go on from its node
+        if "n" in state and self.state_machine is not None and state.get("m") == self.state_machine.digest.hex():
+            self._node = state["n"]
+
+    def compact(self):
+        """
+        Returns the conversation as a ConversationState, or as a MachineState
+        while it runs on the state machine.
+        """
+        if self._node is not None:
+            return MachineState(self.knowledge_base, self._node)
+        registry = self.registry
+        evidence = self._evidence
+        if any(value is not None for value in evidence):
+            evidence = bytes(UNKNOWN if value is None else value for value in evidence)
+        else:
+            evidence = NO_EVIDENCE
+        return ConversationState(
+            self.knowledge_base, self._question,
+            _pack([registry.encode_fact(fact, value) for fact, value in self.engine.known_facts()]),
+            _pack([registry.encode_question(question) for question in self.engine.get_questions()]), evidence)
+
+    def restore(self, state):
+        """
+        Restores a ConversationState or MachineState into a fresh chatbot, on the knowledge base it was taken on.
+        """
+        if state.knowledge_base is not self.knowledge_base:
+            self.use_knowledge_base(state.knowledge_base)
+        if isinstance(state, MachineState):
+            self._node = state.node
+            self._question = self.state_machine.question(state.node)
+            return
+        self._node = None
+        registry = self.registry
+        if state.facts:
+            # Replaying facts may queue questions again, the queue is the one saved
+            self.engine.restore_facts([registry.decode_fact(fact) for fact in state.facts])
+            self.engine.clear_questions()
+        self.engine.get_questions().extend(registry.decode_question(question) for question in state.queued)
+        self._question = state.question
+        if state.evidence is not NO_EVIDENCE:
+            self._evidence = [None if value == UNKNOWN else value for value in state.evidence]
+
+    def update_probabilities(self, question, value):
+        # Get the evidence slot of the question (by id, or by text when the registry does not know it)
+        if type(question) is int:
+            slot = self.registry.evidence_slot[question]
+        else:
+            slot = EVIDENCE_SLOTS[question] if question in QUESTION_VARIABLES else -1
+        if slot >= 0:
+            bayesian_var = SLOT_VARIABLES[slot]
+            self._evidence[slot] = int(value == 'yes')
+            
+            if bayesian_var == 'Battery':
+                problems = self._count_problems(BATTERY_PROBLEMS)
+                self._evidence[BATTERY] = 1 if problems >= 2 else 0
+            elif bayesian_var in ['BrakeSystem', 'BrakePedal']:
+                problems = self._count_problems(BRAKE_PROBLEMS)
+                self._evidence[BRAKE_FAILURE] = 1 if problems >= 1 else 0
+            elif bayesian_var in ['ElectricalSystem', 'Alternator']:
+                problems = self._count_problems(ELECTRICAL_PROBLEMS)
+                self._evidence[ELECTRICAL_FAILURE] = 1 if problems >= 1 else 0
+            
+            try:
+                prob_failure = self._calculate_system_probability(bayesian_var)
+                return prob_failure, bayesian_var
+                    
+            except Exception as e:
+                return None, None
+        
+        return None, None
+
+    def _count_problems(self, checks):
+        evidence = self._evidence
+        return sum(evidence[slot] == value for slot, value in checks)
+
+    def _calculate_system_probability(self, bayesian_var):
+        # Create a dictionary of evidence only with the variables of the Bayesian network
+        bayesian_evidence = {}
+        
+        if bayesian_var in ['Battery', 'Ignition']:
+            bayesian_evidence['Battery'] = self._evidence[BATTERY] or 0
+            prob_failure = self.inference.query('NoStart', bayesian_evidence)[1]
+            problems = self._count_problems(BATTERY_PROBLEMS)
+            
+        elif bayesian_var in ['BrakeSystem', 'BrakePedal']:
+            bayesian_evidence['BrakeFailure'] = self._evidence[BRAKE_FAILURE] or 0
+            prob_failure = self.inference.query('BrakeFailure', bayesian_evidence)[1]
+            problems = self._count_problems(BRAKE_PROBLEMS)
+            
+        elif bayesian_var in ['ElectricalSystem', 'Alternator']:
+            prob_failure = self.inference.query('ElectricalFailure', self.evidence)[1]
+            problems = self._count_problems(ELECTRICAL_PROBLEMS)
+        
+        # Adjust the probability based on the number of problems
+        if problems == 1:
+            prob_failure = (prob_failure + 0.3) / 2
+        elif problems >= 2:
+            prob_failure = (prob_failure + 0.7) / 2
+            
+        return prob_failure
+
+    def diagnose(self, message):
+        """
+        Returns the whole reply to `message`, probability annotation first.
+        """
+        reply, probability = None, None
+        for event, text in self.diagnose_events(message):
+            if event == 'probability':
+                probability = text
+            else:
+                reply = text
+        return reply if probability is None else f"{probability} {reply}"
+
+    def diagnose_events(self, message):
+        """
+        Yields the reply to `message` in parts, as `(event, text)` pairs, as soon
+        as each is ready: first the next 'question', the 'diagnostic' or another
+        'message', then, for answers to a question, the 'probability' annotation
+        computed on the Bayesian network (an empty text when there is none).
+
+        The conversation state is only final once the generator is exhausted.
+        """
+        events = self._turn_events(message)
+        if self._restarted:
+            self._restarted = False
+            for event, text in events:
+                yield event, f"{RESTARTED_NOTICE} {text}"
+                break
+        yield from events
+
+    def _turn_events(self, message):
+    # Normalize and clean the input message
+        message = message.lower()
+        message = re.sub(r'[^\w\s]', '', message)
+
+        # A conversation finishes on the knowledge base it started with; the next one picks up reloads
+        if self.follow_reloads and self._question is None:
+            latest = get_knowledge_base()
+            if latest is not self.knowledge_base:
+                self._leave_machine()
+                self.use_knowledge_base(latest)
+
+        if self._node is None and self.state_machine is not None:
+            self._enter_machine()
+        if self._node is not None:
+            yield from self._machine_events(message)
+            return
+
+        # Openers only depend on the message while nothing is left queued from before
+        cacheable = not self.engine.get_questions()
+        cache_key = (message, self.knowledge_base.version, self.engine_mode)
+        if cacheable:
+            with timed_stage('matching'):
+                opener = opener_cache.get(cache_key)
+            if opener is not None:
+                self._replay_opener(opener)
+                yield 'question', opener.reply
+                return
+
+        # Check if the message matches a known symptom
+        with timed_stage('matching'):
+            match = self.knowledge_base.symptom_matcher.match(message)
+        if match:
+            question, asks = self._open_symptom(match.label)
+            if cacheable:
+                opener_cache.put(cache_key, Opener(
+                    question, self._question if asks else None, tuple(tuple(pair) for pair in self.engine.known_facts()),
+                    tuple(self.engine.get_questions()), match.label == 'no_start'))
+            yield 'question', question
+            return
+
+        # Process the message as an answer to the current question
+        if self._question is not None:
+            question = self._question
+
+            # Declare the fact based on the current response
+            with timed_stage('rules'):
+                expected_fact = self._expected_fact(question)
+                if expected_fact:
+                    self.engine.assert_fact(expected_fact, message)
+
+                next_question = self.process_questions()
+
+            # The next question or the diagnostic goes out before the network is queried
+            completed = "Diagnostic:" in next_question
+            if completed:
+                self._question = None
+                yield 'diagnostic', f"{next_question}\nDiagnosis completed. Is there any other issue you'd like to discuss?"
+            else:
+                yield 'question', next_question
+
+            with timed_stage('inference'):
+                prob, bayesian_var = self.update_probabilities(question, message)
+            probability_message = ""
+
+            if prob:
+                # Map Bayesian variables to system names
+                system_names = {
+                    'Battery': 'Battery System',
+                    'Ignition': 'Ignition System',
+                    'BrakeSystem': 'Brake System',
+                    'BrakePedal': 'Brake System',
+                    'ElectricalSystem': 'Electrical System',
+                    'Alternator': 'Electrical System'
+                }
+                system_name = system_names.get(bayesian_var, 'System')
+
+                if prob > 0.7:
+                    probability_message = f"High probability ({prob:.2f}) of failure in the {system_name}. Immediate inspection recommended.\n"
+                elif prob > 0.5:
+                    probability_message = f"Moderate to high probability ({prob:.2f}) of failure in the {system_name}.\n"
+                elif prob > 0.3:
+                    probability_message = f"Some indicators of possible failure ({prob:.2f}) in the {system_name}.\n"
+
+            if completed:
+                self._evidence = [None] * len(EVIDENCE_NAMES)
+            yield 'probability', probability_message
+            return
+
+        # A misspelled symptom ("car wont strt"); not cached as an opener, since while a
+        # question is pending the same message is taken as its answer
+        with timed_stage('matching'):
+            match = self.knowledge_base.fuzzy_symptom_matcher.match(message)
+        if match:
+            yield 'question', self._open_symptom(match.label)[0]
+            return
+
+        # Handle generic responses
+        with timed_stage('matching'):
+            generic_response = GENERIC_RESPONSE_MATCHER.match(message)
+        if generic_response:
+            yield 'message', self.respond_to_input(message)
+            return
+
+        # If no valid symptom or answer was detected
+        yield 'message', "Sorry, I don't understand the problem. Could you describe the symptom in another way?"
+
+
+    def _machine_events(self, message):
+        # The same dispatch as _turn_events(), with the replies and the next state read from the machine
+        machine = self.state_machine
+        with timed_stage('matching'):
+            match = self.knowledge_base.symptom_matcher.match(message)
+            if match is None and self._question is None:
+                match = self.knowledge_base.fuzzy_symptom_matcher.match(message)
+        if match:
+            symbol = machine.labels[match.label]
+        elif self._question is not None:
+            symbol = machine.answer_symbol(message)
+        else:
+            with timed_stage('matching'):
+                generic_response = GENERIC_RESPONSE_MATCHER.match(message)
+            if generic_response:
+                yield 'message', self.respond_to_input(message)
+            else:
+                yield 'message', "Sorry, I don't understand the problem. Could you describe the symptom in another way?"
+            return
+        with timed_stage('rules'):
+            self._node, event, reply, probability = machine.step(self._node, symbol)
+            self._question = machine.question(self._node)
+        yield event, reply
+        if probability is not None:
+            yield 'probability', probability
+
+    def _open_symptom(self, label):
+        # Starts a new diagnosis from a symptom; returns its first question and whether it asks one
+        fact, value = self.knowledge_base.symptom_facts[label]
+        with timed_stage('rules'):
+            self.engine.reset()
+            self.engine.assert_fact(fact, value)
+            if label == 'no_start':
+                self._evidence = [None] * len(EVIDENCE_NAMES)
+            asks = bool(self.engine.get_questions())
+            return self.process_questions(), asks
+
+    def _expected_fact(self, question):
+        if type(question) is int:
+            return self.registry.expected_fact[question]
+        return self.engine.expected_facts.get(question)
+
+    def _replay_opener(self, opener):
+        # Puts the conversation in the state the cached opener left it in
+        with timed_stage('rules'):
+            self.engine.reset()
+            self.engine.restore_facts(opener.facts)
+            self.engine.clear_questions()
+            self.engine.get_questions().extend(opener.queued)
+        if opener.question is not None:
+            self._question = opener.question
+        if opener.resets_evidence:
+            self._evidence = [None] * len(EVIDENCE_NAMES)
+
+    def process_questions(self):
+        """
+        Retrieves the next question from the list of questions generated by the engine.
+        """
+        questions = self.engine.get_questions()
+        if questions:
+            self.current_question = questions[0]
+            return questions.pop(0)
+        return "There are no more questions."
+
+    def respond_to_input(self, message):
+        """
+        Processes the user's input as a response to the current question.
+        """
+        # If there is no current question, ask the user to describe the issue
+        if self._question is None:
+            return "There are no pending questions. Please describe the problem you are experiencing with your vehicle."
+
+        # Determine if the response is 'yes' or 'no'
+        with timed_stage('matching'):
+            match = ANSWER_MATCHER.match(message.lower())
+        response = match.label if match else None
+
+        if response:
+            # Update the rule engine with the response
+            with timed_stage('rules'):
+                expected_fact = self._expected_fact(self._question)
+                if expected_fact:
+                    self.engine.assert_fact(expected_fact, response)
+                    return self.process_questions()
+        
+        return "Please respond with 'yes' or 'no' to the question."
+
+
+def warm_up(engine_mode=None):
+    """
+    Does the one-off work of a process ahead of its first conversation:
+    builds the knowledge base, loads the engine of the mode (experta is only
+    imported in 'experta' mode, which also fills its engine pool) and fills
+    the opener cache with the first phrase of every symptom. Returns the
+    knowledge base.
+    """
+    knowledge_base = get_knowledge_base()
+    engine_mode = engine_mode or os.environ.get('CHATBOT_ENGINE', 'graph')
+    if engine_mode == 'experta':
+        knowledge_base.engine_pool.fill()
+    for phrases in SYMPTOMS.values():
+        chatbot = CarTroubleshootingChatbot(engine_mode, knowledge_base)
+        chatbot.diagnose(phrases[0])
+        chatbot.release()
+    return knowledge_base
@@ -0,0 +1,96 @@
+from collections import namedtuple
+from types import MappingProxyType
+import inspect
+
+
+# Effect of declaring one `(fact, value)`: the messages its rule appends to the
+# question list and the facts it declares in turn (e.g. `drop_on_shifts_yes`)
+Step = namedtuple('Step', ['questions', 'declares'])
+
+
+class _RuleRecorder:
+    """
+    Stands in for the engine while a rule body runs, recording what it does.
+    """
+
+    def __init__(self):
+        self.questions = []
+        self.expected_facts = {}
+        self.declared = []
+
+    def declare(self, *facts):
+        for fact in facts:
+            self.declared.extend(fact.items())
+
+
+class DecisionGraph:
+    """
+    Immutable `(fact, answer) -> Step` graph compiled from a rule engine class.
+    """
+
+    def __init__(self, transitions, expected_facts):
+        self.transitions = MappingProxyType(dict(transitions))
+        self.expected_facts = MappingProxyType(dict(expected_facts))
+
+    def step(self, fact, value):
+        return self.transitions.get((fact, value))
+
+
+def compile_rules(engine_class):
+    """
+    Walks the single-fact rules of a KnowledgeEngine class and returns its DecisionGraph.
+    """
+    from experta import Rule
+
+    transitions = {}
+    expected_facts = {}
+    for name, rule in inspect.getmembers(engine_class, lambda member: isinstance(member, Rule)):
+        if len(rule) != 1 or len(rule[0]) != 1:
+            raise ValueError(f"Rule {name} does not match exactly one fact and cannot be compiled")
+        (fact, value), = rule[0].items()
+        recorder = _RuleRecorder()
+        rule._wrapped(recorder)
+        transitions[(fact, value)] = Step(tuple(recorder.questions), tuple(recorder.declared))
+        expected_facts.update(recorder.expected_facts)
+    return DecisionGraph(transitions, expected_facts)
+
+
+class GraphEngine:
+    """
+    Serves conversation turns from a DecisionGraph with the same interface the
+    chatbot uses on CarTroubleshootingSystem, without running the Rete network.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.expected_facts = graph.expected_facts
+        self.questions = []
+        self.facts = set()
+
+    def get_questions(self):
+        return self.questions
+
+    def clear_questions(self):
+        self.questions.clear()
+
+    def reset(self):
+        # Like KnowledgeEngine.reset(), only the working memory is cleared
+        self.facts = set()
+
+    def assert_fact(self, fact, value):
+        # Facts already in working memory do not fire their rule again
+        if (fact, value) in self.facts:
+            return
+        self.facts.add((fact, value))
+        step = self.graph.step(fact, value)
+        if step is None:
+            return
+        self.questions.extend(step.questions)
+        for declared_fact, declared_value in step.declares:
+            self.assert_fact(declared_fact, declared_value)
+
+    def known_facts(self):
+        return list(self.facts)
+
+    def restore_facts(self, facts):
+        self.facts = {tuple(pair) for pair in facts}
@@ -1,22 +1,80 @@
+import asyncio
 import datetime
+import hmac
+import json
+import logging
 import sys
 import os
 from datetime import datetime
+from typing import List, Optional
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from app.car_troubleshooting import CarTroubleshootingChatbot  # Ajuste en la importación
+from app.batch import BatchReplayer
+from app.chatbot import CarTroubleshootingChatbot  # Ajuste en la importación
+from app.knowledge_base import current_knowledge_base, reload_knowledge_base
+from app.log_writer import ChatLogWriter
+from app.metrics import render_metrics
+from app.sessions import SESSION_COOKIE, SESSION_HEADER, create_session_store, new_session_id, resolve_session_id
+from app.workers import DiagnosisPool, PoolSaturated
+
+logger = logging.getLogger(__name__)
 
 # Inicializamos el router de la API
 router = APIRouter()
 
-# Instancia del sistema experto
-chatbot = CarTroubleshootingChatbot()
+# One conversation state per session id, kept in the backend chosen by SESSION_BACKEND
+sessions = create_session_store(CarTroubleshootingChatbot)
+
+# Diagnosis turns run on a worker pool, each session pinned to one worker
+diagnosis_pool = DiagnosisPool(
+    sessions,
+    workers=int(os.environ.get("DIAGNOSIS_WORKERS", str(os.cpu_count() or 4))),
+    max_pending=int(os.environ.get("DIAGNOSIS_MAX_PENDING", "256")),
+    mode=os.environ.get("DIAGNOSIS_POOL", "thread"),
+    retry_after=int(os.environ.get("DIAGNOSIS_RETRY_AFTER", "1")),
+)
+
+# Recorded conversations replayed through /chat/batch, spread over processes
+batch_replayer = BatchReplayer(
+    workers=int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1))),
+    chunk_size=int(os.environ.get("BATCH_CHUNK_SIZE", "64")),
+)
+BATCH_MAX_CONVERSATIONS = int(os.environ.get("BATCH_MAX_CONVERSATIONS", "10000"))
+
+# Chat logs are written in batches by a background thread
+chat_log = ChatLogWriter(
+    path=os.environ.get("CHAT_LOG_PATH", "chat_logs.log"),
+    max_bytes=int(os.environ.get("CHAT_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backup_count=int(os.environ.get("CHAT_LOG_BACKUPS", "5")),
+)
+
+# WebSocket chats get a ping after WS_HEARTBEAT_INTERVAL idle seconds and are
+# closed after WS_IDLE_TIMEOUT seconds without hearing from the client
+WS_HEARTBEAT_INTERVAL = float(os.environ.get("WS_HEARTBEAT_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.environ.get("WS_IDLE_TIMEOUT", "60"))
+
+# Admin endpoints require this token in X-Admin-Token, and are disabled while it is not set
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled: ADMIN_TOKEN is not set.")
+    if not hmac.compare_digest((x_admin_token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
 
 # Modelo para validar el mensaje del usuario
 class UserMessage(BaseModel):
     message: str
 
+# Conversaciones independientes a reproducir, cada una una lista de mensajes
+class ConversationBatch(BaseModel):
+    conversations: List[List[str]]
+    stream: bool = False
+
 
 
 @router.post("/log")
@@ -26,27 +84,195 @@ async def save_log(log: dict):
     message = log.get("message", "No message provided")
     
     # Guardar el log en un archivo
-    with open("chat_logs.log", "a") as file:
-        file.write(f"{timestamp} - {sender}: {message}\n")
+    chat_log.write(f"{timestamp} - {sender}: {message}\n")
     
     return {"status": "success"}
 
 @router.get("/get")
 async def simple_get():
-    print("Endpoint GET funcionando correctamente")
+    logger.debug("Endpoint GET funcionando correctamente")
     return {"message": "El endpoint GET está funcionando correctamente"}
 
 
+# Liveness: the process is up and serving the event loop
+@router.get("/health/live")
+async def health_live():
+    return {"status": "live"}
+
+
+# Readiness: 503 mientras la base de conocimiento se sigue cargando (o si falló la carga)
+@router.get("/health/ready")
+async def health_ready(request: Request, http_response: Response):
+    warmup = getattr(request.app.state, "warmup", None)
+    if warmup is not None and not warmup.done():
+        http_response.status_code = 503
+        return {"status": "starting"}
+    if warmup is not None and not warmup.cancelled() and warmup.exception() is not None:
+        http_response.status_code = 503
+        return {"status": "failed", "error": str(warmup.exception())}
+    knowledge_base = current_knowledge_base()
+    # The pid tells apart the workers answering behind one port
+    return {"status": "ready", "kb_version": knowledge_base.version if knowledge_base else None, "pid": os.getpid()}
+
+
 @router.post("/chat")
-async def chat_with_bot(user_message: UserMessage):
+async def chat_with_bot(user_message: UserMessage, request: Request, http_response: Response):
+    session_id = resolve_session_id(request.headers, request.cookies) or new_session_id()
+    http_response.headers[SESSION_HEADER] = session_id
+    http_response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="lax")
     try:
-        print(f"Received message: {user_message.message}")
+        logger.debug("Received message", extra={"session_id": session_id, "chat_message": user_message.message})
         
         # Diagnosing the issue
-        response = chatbot.diagnose(user_message.message)
+        response = await diagnosis_pool.diagnose(session_id, user_message.message)
         
-        print(f"Chatbot response: {response}")
+        logger.debug("Chatbot response", extra={"session_id": session_id, "chat_response": response})
         return {"response": response}
-    except Exception as e:
-        print(f"Error in /chat endpoint: {e}")  # Log the error for debugging
+    except PoolSaturated as e:
+        logger.warning("Diagnosis pool saturated", extra={"session_id": session_id})
+        raise HTTPException(status_code=503, detail="The server is busy, please retry.",
+                            headers={"Retry-After": str(e.retry_after)})
+    except Exception:
+        logger.exception("Error in /chat endpoint", extra={"session_id": session_id})
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+
+def sse_event(event, data):
+    # Server-Sent Events frame; the JSON payload keeps multi-line texts on one data line
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(user_message: UserMessage, request: Request):
+    session_id = resolve_session_id(request.headers, request.cookies) or new_session_id()
+    logger.debug("Received message", extra={"session_id": session_id, "chat_message": user_message.message})
+    try:
+        events = diagnosis_pool.diagnose_events(session_id, user_message.message)
+    except PoolSaturated as e:
+        logger.warning("Diagnosis pool saturated", extra={"session_id": session_id})
+        raise HTTPException(status_code=503, detail="The server is busy, please retry.",
+                            headers={"Retry-After": str(e.retry_after)})
+
+    # Next question or diagnostic first, then the probability annotation, then 'done'
+    async def stream():
+        try:
+            async for event, text in events:
+                if text:
+                    yield sse_event(event, {"text": text})
+        except Exception:
+            logger.exception("Error in /chat/stream endpoint", extra={"session_id": session_id})
+            yield sse_event("error", {"detail": "An internal server error occurred."})
+        yield sse_event("done", {})
+
+    response = StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                                          SESSION_HEADER: session_id})
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="lax")
+    return response
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    One diagnosis session per connection. The client sends
+    {"type": "message", "message": ...}, {"type": "ping"} or {"type": "pong"};
+    each message is answered with the events of /chat/stream as
+    {"type": "question" | "diagnostic" | "message" | "probability", "text": ...}
+    followed by {"type": "done"}.
+
+    A turn is read only after the previous one has been sent, so a client
+    writing faster than it is served is held back by the socket's flow control.
+    """
+    await websocket.accept()
+    session_id = new_session_id()
+    loop = asyncio.get_running_loop()
+    last_seen = loop.time()
+    try:
+        await websocket.send_json({"type": "session", "session_id": session_id})
+        while True:
+            try:
+                data = await asyncio.wait_for(websocket.receive_json(), WS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                if loop.time() - last_seen >= WS_IDLE_TIMEOUT:
+                    await websocket.close(code=1001, reason="Idle timeout")
+                    break
+                await websocket.send_json({"type": "ping"})
+                continue
+            except json.JSONDecodeError:
+                await websocket.send_json({"type": "error", "detail": "Messages must be JSON objects."})
+                continue
+            last_seen = loop.time()
+
+            kind = data.get("type") if isinstance(data, dict) else None
+            if kind == "ping":
+                await websocket.send_json({"type": "pong"})
+                continue
+            if kind == "pong":
+                continue
+            if kind != "message" or not isinstance(data.get("message"), str):
+                await websocket.send_json({"type": "error", "detail": "Expected a message, ping or pong."})
+                continue
+
+            logger.debug("Received message", extra={"session_id": session_id, "chat_message": data["message"]})
+            try:
+                events = diagnosis_pool.diagnose_events(session_id, data["message"])
+            except PoolSaturated as e:
+                logger.warning("Diagnosis pool saturated", extra={"session_id": session_id})
+                await websocket.send_json({"type": "error", "detail": "The server is busy, please retry.",
+                                           "retry_after": e.retry_after})
+                # A rejected turn still ends like any other
+                await websocket.send_json({"type": "done"})
+                continue
+            try:
+                async for event, text in events:
+                    if text:
+                        await websocket.send_json({"type": event, "text": text})
+            except WebSocketDisconnect:
+                raise
+            except Exception:
+                logger.exception("Error in /ws/chat endpoint", extra={"session_id": session_id})
+                await websocket.send_json({"type": "error", "detail": "An internal server error occurred."})
+            await websocket.send_json({"type": "done"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # The session does not outlive its connection
+        diagnosis_pool.end_session(session_id)
+
+
+@router.post("/chat/batch")
+async def chat_batch(batch: ConversationBatch):
+    if len(batch.conversations) > BATCH_MAX_CONVERSATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_CONVERSATIONS} conversations per batch.")
+
+    if batch.stream:
+        # One JSON object per line as soon as each chunk of conversations finishes
+        async def results():
+            async for result in batch_replayer.replay_as_completed(batch.conversations):
+                yield json.dumps(result) + "\n"
+        return StreamingResponse(results(), media_type="application/x-ndjson")
+
+    return {"results": await batch_replayer.replay(batch.conversations)}
+
+
+@router.post("/admin/reload", dependencies=[Depends(require_admin)])
+async def reload_knowledge():
+    # Built off the event loop; conversations in progress keep their version
+    try:
+        knowledge_base = await run_in_threadpool(reload_knowledge_base)
+    except Exception as e:
+        logger.exception("Knowledge base reload failed")
+        raise HTTPException(status_code=500, detail=f"Knowledge base reload failed: {e}")
+    return {"status": "success", "version": knowledge_base.version}
+
+
+# Número de sesiones y memoria que ocupan (bytes es None cuando el store no lo mide)
+@router.get("/admin/sessions", dependencies=[Depends(require_admin)])
+async def session_stats():
+    return await diagnosis_pool.session_stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
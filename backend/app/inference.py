@@ -0,0 +1,298 @@
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+INFERENCE_BACKENDS = ('numpy', 'pgmpy')
+
+
+def _bayesian_network(network):
+    # A `network` section of a knowledge-base file is built into a pgmpy model only when asked for
+    if isinstance(network, dict):
+        from app.knowledge_file import build_bayesian_network
+        return build_bayesian_network(network)
+    return network
+
+
+def _network_tables(network):
+    """
+    Returns {variable: (scope, values, state names)} for every CPD of a pgmpy
+    model or a `network` section. `scope` is the variable followed by its
+    parents and `values` has one axis per variable of the scope, in order.
+    """
+    if not isinstance(network, dict):
+        return {cpd.variable: (list(cpd.variables), cpd.values, list(cpd.state_names[cpd.variable]))
+                for cpd in network.get_cpds()}
+    tables = {}
+    for cpd in network["cpds"]:
+        evidence = list(cpd.get("evidence") or [])
+        values = np.array(cpd["values"], dtype=float).reshape([cpd["card"], *(cpd.get("evidence_card") or [])])
+        if not np.allclose(values.sum(axis=0), 1):
+            raise ValueError(f"Sum or integral of conditional probabilities for node {cpd['variable']} is not equal to 1.")
+        tables[cpd["variable"]] = ([cpd["variable"], *evidence], values, list(range(cpd["card"])))
+    for variable, (scope, values, _) in tables.items():
+        for parent, card in zip(scope[1:], values.shape[1:]):
+            if parent not in tables or len(tables[parent][2]) != card:
+                raise ValueError(f"The cardinality of {parent} in the CPD of {variable} does not match")
+    return tables
+
+
+def _components(tables):
+    """
+    Returns the variables of every connected component of the network, each list sorted.
+    """
+    roots = {variable: variable for variable in tables}
+
+    def find(variable):
+        while roots[variable] != variable:
+            roots[variable] = roots[roots[variable]]
+            variable = roots[variable]
+        return variable
+
+    for variable, (scope, _, _) in tables.items():
+        for parent in scope[1:]:
+            roots[find(parent)] = find(variable)
+    components = {}
+    for variable in tables:
+        components.setdefault(find(variable), []).append(variable)
+    return [sorted(variables) for variables in components.values()]
+
+
+class PgmpyInference:
+    """
+    Posterior queries through pgmpy's general VariableElimination.
+    """
+
+    def __init__(self, network):
+        from pgmpy.inference import VariableElimination
+        self.model = _bayesian_network(network)
+        self._elimination = VariableElimination(self.model)
+
+    def state_names(self, variable):
+        return list(self.model.get_cpds(variable).state_names[variable])
+
+    def posterior(self, variable, evidence):
+        return tuple(float(value) for value in
+                     self._elimination.query([variable], evidence=dict(evidence), show_progress=False).values)
+
+    def posteriors(self, variable, evidence_variables, rows):
+        return np.array([self.posterior(variable, dict(zip(evidence_variables, row))) for row in rows])
+
+
+class TensorInference:
+    """
+    Exact inference for small discrete Bayesian networks with NumPy.
+
+    Every connected component of the network is multiplied out once into a
+    joint probability tensor with one axis per variable. A posterior is then a
+    slice of that tensor summed over the other axes and normalized, and
+    `posteriors()` answers many evidence assignments with one einsum and one
+    fancy-indexing step. Only meant for networks like the diagnostic ones,
+    whose components have a handful of variables each.
+
+    Queries pgmpy rejects (the variable also in the evidence, unknown
+    variables or states) raise here too. The network is a pgmpy model or the
+    `network` section of a knowledge-base file, which is read without
+    importing pgmpy.
+    """
+
+    def __init__(self, network):
+        self._network = network
+        cpds = _network_tables(network)
+        # variable -> {state name: index along its axis}
+        self._states = {variable: {name: index for index, name in enumerate(states)}
+                        for variable, (_, _, states) in cpds.items()}
+        # variable -> (variables of its component, joint tensor over them)
+        self._components = {}
+        for variables in _components(cpds):
+            axes = {name: axis for axis, name in enumerate(variables)}
+            operands = []
+            for name in variables:
+                scope, values, _ = cpds[name]
+                operands += [values, [axes[parent] for parent in scope]]
+            joint = np.einsum(*operands, list(range(len(variables))))
+            for name in variables:
+                self._components[name] = (variables, joint)
+
+    @property
+    def model(self):
+        if isinstance(self._network, dict):
+            self._network = _bayesian_network(self._network)
+        return self._network
+
+    def state_names(self, variable):
+        return list(self._states[variable])
+
+    def _check(self, variable, evidence_variables):
+        if variable in evidence_variables:
+            raise ValueError(f"Can't have the same variables in both `variables` and `evidence`. Found in both: {{{variable!r}}}")
+        for name in [variable, *evidence_variables]:
+            if name not in self._components:
+                raise ValueError(f"Node {name} not in graph")
+
+    def _state_index(self, variable, state):
+        try:
+            return self._states[variable][state]
+        except KeyError:
+            raise KeyError(state) from None
+
+    def _state_indexes(self, variable, states):
+        lookup = self._states[variable]
+        if all(name == index for index, name in enumerate(lookup)):
+            # Default state names are the indexes themselves
+            try:
+                indexes = states.astype(np.intp)
+            except (TypeError, ValueError):
+                indexes = None
+            if indexes is not None and (indexes == states).all() and ((indexes >= 0) & (indexes < len(lookup))).all():
+                return indexes
+        return np.array([self._state_index(variable, state) for state in states], dtype=np.intp)
+
+    def posterior(self, variable, evidence):
+        """
+        Returns the posterior distribution of `variable` given `evidence` as a tuple of floats.
+        """
+        self._check(variable, evidence)
+        variables, joint = self._components[variable]
+        index = tuple(self._state_index(name, evidence[name]) if name in evidence else slice(None)
+                      for name in variables)
+        # Axes still present after indexing, in order, to find the queried one
+        remaining = [name for name in variables if name not in evidence]
+        axis = remaining.index(variable)
+        marginal = joint[index].sum(axis=tuple(i for i in range(len(remaining)) if i != axis))
+        return tuple(float(value) for value in marginal / marginal.sum())
+
+    def posteriors(self, variable, evidence_variables, rows):
+        """
+        Returns an array with one posterior distribution of `variable` per row
+        of `rows`, each row holding the states of `evidence_variables`.
+        """
+        evidence_variables = list(evidence_variables)
+        self._check(variable, evidence_variables)
+        variables, joint = self._components[variable]
+        # Evidence outside the variable's component does not change its posterior
+        local = [i for i, name in enumerate(evidence_variables) if name in variables]
+        axes = [variables.index(evidence_variables[i]) for i in local] + [variables.index(variable)]
+        table = np.einsum(joint, list(range(len(variables))), axes)
+        if not local:
+            result = np.repeat(table[np.newaxis], len(rows), axis=0)
+        else:
+            states = np.asarray(rows, dtype=object).reshape(len(rows), len(evidence_variables))
+            result = table[tuple(self._state_indexes(evidence_variables[i], states[:, i]) for i in local)]
+        return result / result.sum(axis=-1, keepdims=True)
+
+
+class _Failure:
+    """
+    What the cache keeps for a query the backend rejected: the error's type
+    and arguments, not the exception itself, whose traceback would keep the
+    callers' frames alive and grow with every raise.
+    """
+
+    __slots__ = ('type', 'args')
+
+    def __init__(self, error):
+        self.type = type(error)
+        self.args = error.args
+
+    def error(self):
+        try:
+            return self.type(*self.args)
+        except Exception:
+            return RuntimeError(*self.args)
+
+
+class CachedInference:
+    """
+    Memoizes posterior queries on a Bayesian network.
+
+    Results are kept in a bounded LRU table keyed by the queried variable and
+    the frozen evidence, so repeated queries become a dict lookup. Queries that
+    the backend rejects are cached as well and raise an equal error again.
+    `backend` is 'numpy' (TensorInference) or 'pgmpy', by default taken from
+    INFERENCE_BACKEND. The network is a pgmpy model or the `network` section
+    of a knowledge-base file; with the 'numpy' backend the latter never
+    imports pgmpy unless `model` is read.
+    """
+
+    def __init__(self, network, maxsize=4096, backend=None):
+        backend = backend or os.environ.get('INFERENCE_BACKEND', 'numpy')
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend {backend!r}, expected one of {INFERENCE_BACKENDS}")
+        self.backend = backend
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.load(network)
+
+    def load(self, network):
+        """
+        Uses a new (or reloaded) network, invalidating every cached posterior.
+        """
+        inference = TensorInference(network) if self.backend == 'numpy' else PgmpyInference(network)
+        with self._lock:
+            self._inference = inference
+            self._cache.clear()
+
+    @property
+    def model(self):
+        return self._inference.model
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def query(self, variable, evidence):
+        """
+        Returns the posterior distribution of `variable` as a tuple of floats.
+        """
+        key = (variable, tuple(sorted(evidence.items())))
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+        if result is None:
+            try:
+                result = self._inference.posterior(variable, evidence)
+            except Exception as e:
+                self._store(key, _Failure(e))
+                raise
+            self._store(key, result)
+        if isinstance(result, _Failure):
+            # A new exception on every hit, so no traceback is shared between callers or threads
+            raise result.error()
+        return result
+
+    def query_many(self, variable, evidence_variables, rows):
+        """
+        Returns an array of posteriors of `variable`, one per row of evidence
+        states, computed in one batch and bypassing the cache. Meant for bulk
+        replay and what-if analysis over many evidence combinations.
+        """
+        return self._inference.posteriors(variable, evidence_variables, rows)
+
+    def precompute(self, variable, evidence_variables):
+        """
+        Fills the table with every combination of states of `evidence_variables`.
+        """
+        states = [self._inference.state_names(name) for name in evidence_variables]
+        rows = list(itertools.product(*states))
+        try:
+            posteriors = self.query_many(variable, evidence_variables, rows)
+        except Exception:
+            return
+        for row, posterior in zip(rows, posteriors):
+            key = (variable, tuple(sorted(zip(evidence_variables, row))))
+            self._store(key, tuple(float(value) for value in posterior))
+
+    def _store(self, key, result):
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.matching import FuzzyPhraseMatcher, PhraseMatcher
+
+
+logger = logging.getLogger(__name__)
+
+# Marks a lazily loaded attribute that may legitimately be None
+_NOT_LOADED = object()
+
+
+class KnowledgeBase:
+    """
+    Read-only data shared by every conversation in the process: the compiled
+    rule graph, the Bayesian network with its posterior table and the symptom
+    matchers. Conversations only keep their own mutable state next to it.
+
+    A reload builds a new KnowledgeBase with a higher `version` rather than
+    changing this one, so conversations holding it are not affected.
+    """
+
+    def __init__(self, graph, inference, symptoms, symptom_facts, engine_class=None, version=None, digest=None):
+        self.graph = graph
+        self.inference = inference
+        self.symptoms = {label: tuple(phrases) for label, phrases in symptoms.items()}
+        self.symptom_matcher = PhraseMatcher(symptoms)
+        # Fallback for misspelled symptoms; FUZZY_MATCH_THRESHOLD is the minimum confidence
+        self.fuzzy_symptom_matcher = FuzzyPhraseMatcher(symptoms, float(os.environ.get('FUZZY_MATCH_THRESHOLD', '0.8')),
+                                                        max_tokens=int(os.environ.get('FUZZY_MATCH_MAX_TOKENS', '32')))
+        self.symptom_facts = dict(symptom_facts)
+        # Every knowledge base gets its own version, which also keys the opener cache
+        self.version = next(_versions) if version is None else version
+        # SHA-1 of the knowledge-base file it was loaded from (None when compiled from code)
+        self.digest = digest
+        self._engine_class = engine_class
+        self._policy = None
+        self._registry = None
+        self._engine_pool = None
+        self._state_machine = _NOT_LOADED
+
+    @property
+    def engine_class(self):
+        # The experta engine is only generated when the 'experta' engine mode asks for it
+        if self._engine_class is None:
+            from app.knowledge_file import build_engine_class
+            self._engine_class = build_engine_class(self.graph)
+        return self._engine_class
+
+    @property
+    def engine_pool(self):
+        # Built experta engines reused across conversations; ENGINE_POOL_SIZE bounds the idle ones
+        if self._engine_pool is None:
+            from app.engine_pool import EnginePool
+            self._engine_pool = EnginePool(self.engine_class,
+                                           int(os.environ.get('ENGINE_POOL_SIZE', str(os.cpu_count() or 4))))
+        return self._engine_pool
+
+    @property
+    def policy(self):
+        # The adaptive question policy, built on first use or at startup in 'adaptive' mode
+        if self._policy is None:
+            from app.adaptive import build_policy
+            self._policy = build_policy(self)
+        return self._policy
+
+    @property
+    def registry(self):
+        # Integer ids of the questions and facts, used by conversations and their saved state
+        if self._registry is None:
+            from app.chatbot import QUESTION_VARIABLES
+            from app.registry import Registry
+            self._registry = Registry(self.graph, tuple(QUESTION_VARIABLES))
+        return self._registry
+
+    @property
+    def state_machine(self):
+        # The materialized 'graph' conversations (app.state_machine), or None without a file built for this version
+        if self._state_machine is _NOT_LOADED:
+            from app.state_machine import load_state_machine
+            self._state_machine = load_state_machine(self)
+        return self._state_machine
+
+    @property
+    def model(self):
+        return self.inference.model
+
+
+_knowledge_base = None
+_lock = threading.Lock()
+_versions = itertools.count(1)
+_watcher = None
+# Versions replaced by a reload, kept for the serialized sessions that started on them: digest -> (kb, last used)
+_superseded = OrderedDict()
+
+
+def knowledge_base_path():
+    from app.knowledge_file import DEFAULT_PATH
+    return os.environ.get('KNOWLEDGE_BASE_PATH', DEFAULT_PATH)
+
+
+def build_knowledge_base(path=None):
+    """
+    Loads the knowledge-base file (KNOWLEDGE_BASE_PATH, by default app/knowledge_base.json),
+    falling back to compiling CarTroubleshootingSystem when there is none. When
+    CHATBOT_ENGINE is 'adaptive' the question policy is precomputed here too.
+    """
+    knowledge_base = _build_knowledge_base(path)
+    if os.environ.get('CHATBOT_ENGINE') == 'adaptive':
+        knowledge_base.policy
+    return knowledge_base
+
+
+def _build_knowledge_base(path):
+    from app.inference import CachedInference
+    from app.knowledge_file import from_document
+
+    path = path or knowledge_base_path()
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        document = from_document(json.loads(data))
+        if document.network:
+            network = document.network
+        else:
+            from app.car_troubleshooting import create_bayesian_network
+            network = create_bayesian_network()
+        inference = CachedInference(network)
+        inference.precompute('NoStart', ['Battery'])
+        return KnowledgeBase(document.graph, inference, document.symptoms, document.symptom_facts,
+                             digest=hashlib.sha1(data).hexdigest())
+
+    from app.car_troubleshooting import CarTroubleshootingSystem, SYMPTOM_FACTS, SYMPTOMS, create_bayesian_network
+    from app.decision_graph import compile_rules
+    inference = CachedInference(create_bayesian_network())
+    inference.precompute('NoStart', ['Battery'])
+    return KnowledgeBase(compile_rules(CarTroubleshootingSystem), inference, SYMPTOMS, SYMPTOM_FACTS,
+                         engine_class=CarTroubleshootingSystem)
+
+
+def get_knowledge_base():
+    """
+    Returns the current process-wide KnowledgeBase, building it on first use.
+    """
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _lock:
+            if _knowledge_base is None:
+                _knowledge_base = build_knowledge_base()
+                interval = float(os.environ.get('KNOWLEDGE_BASE_WATCH_INTERVAL', '0'))
+                if interval > 0:
+                    start_watcher(interval)
+    return _knowledge_base
+
+
+def current_knowledge_base():
+    """
+    Returns the current KnowledgeBase, or None while it has not been built yet.
+    """
+    return _knowledge_base
+
+
+def reload_knowledge_base(path=None):
+    """
+    Builds a new KnowledgeBase and makes it the current one.
+
+    The build happens before taking the lock, so turns served meanwhile keep
+    using the previous version; if it fails, the previous version stays.
+    """
+    global _knowledge_base
+    knowledge_base = build_knowledge_base(path)
+    with _lock:
+        previous, _knowledge_base = _knowledge_base, knowledge_base
+        _superseded.pop(knowledge_base.digest, None)
+        if previous is not None and previous.digest is not None and previous.digest != knowledge_base.digest:
+            _superseded[previous.digest] = (previous, time.monotonic())
+        _prune_superseded(time.monotonic())
+    logger.info("Knowledge base reloaded", extra={"kb_version": knowledge_base.version})
+    return knowledge_base
+
+
+def find_knowledge_base(digest):
+    """
+    Returns the KnowledgeBase loaded from the file with SHA-1 `digest`: the
+    current one or one superseded by a reload, or None when this process
+    never loaded it or no longer keeps it.
+
+    Conversations saved outside the process (SerializedSessionStore) look up
+    the version they started on this way, so they finish on it as live ones
+    do. Superseded versions are kept while they are looked up, until
+    KNOWLEDGE_BASE_RETAIN_SECONDS (by default SESSION_TTL_SECONDS, the idle
+    time after which their sessions expire) pass without that, and at most
+    KNOWLEDGE_BASE_RETAIN_VERSIONS (default 4) of them.
+    """
+    current = get_knowledge_base()
+    if current.digest == digest:
+        return current
+    with _lock:
+        now = time.monotonic()
+        _prune_superseded(now)
+        entry = _superseded.get(digest)
+        if entry is None:
+            return None
+        _superseded[digest] = (entry[0], now)
+        _superseded.move_to_end(digest)
+        return entry[0]
+
+
+def _prune_superseded(now):
+    # Called with _lock held; the dict is ordered by last use
+    retain = float(os.environ.get('KNOWLEDGE_BASE_RETAIN_SECONDS', os.environ.get('SESSION_TTL_SECONDS', '1800')))
+    while _superseded and (len(_superseded) > int(os.environ.get('KNOWLEDGE_BASE_RETAIN_VERSIONS', '4'))
+                           or now - next(iter(_superseded.values()))[1] > retain):
+        _superseded.popitem(last=False)
+
+
+def start_watcher(interval=2.0, path=None):
+    """
+    Polls the knowledge-base file and reloads it whenever its modification time changes.
+    """
+    global _watcher
+    if _watcher is not None:
+        return _watcher
+    path = path or knowledge_base_path()
+
+    def modified_time():
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(stop, last_seen):
+        while not stop.wait(interval):
+            current = modified_time()
+            if current is not None and current != last_seen:
+                last_seen = current
+                try:
+                    reload_knowledge_base(path)
+                except Exception:
+                    logger.exception("Could not reload the knowledge base", extra={"path": path})
+
+    stop = threading.Event()
+    thread = threading.Thread(target=watch, args=(stop, modified_time()), name="kb-watcher", daemon=True)
+    thread.start()
+    _watcher = (thread, stop)
+    return _watcher
+
+
+def _restart_watcher_after_fork():
+    # Threads do not survive a fork, so a process forked with the knowledge base already built
+    # (a preforked server worker, or a process-pool lane) starts its own watcher
+    global _watcher
+    _watcher = None
+    interval = float(os.environ.get('KNOWLEDGE_BASE_WATCH_INTERVAL', '0'))
+    if _knowledge_base is not None and interval > 0:
+        start_watcher(interval)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_watcher_after_fork)
@@ -0,0 +1,155 @@
+"""
+Declarative knowledge-base file.
+
+The troubleshooting tree is stored as JSON instead of one @Rule method per
+answer, so it can be updated without code changes:
+
+    {
+      "format": 1,
+      "symptoms": {"no_start": {"phrases": ["not starting", ...], "fact": ["starter_cranks", "no"]}, ...},
+      "questions": {"Do the Starter spins?": "starter_spins", ...},
+      "transitions": [
+        {"when": ["starter_cranks", "no"], "emit": ["Do the Starter spins?"]},
+        {"when": ["starter_spins", "yes"], "emit": ["Diagnostic: Inspect the solenoid ..."]},
+        {"when": ["drop_on_shifts", "yes"], "declare": [["ticks_moving", "no"]]},
+        ...
+      ],
+      "network": {
+        "edges": [["Battery", "NoStart"], ...],
+        "cpds": [{"variable": "NoStart", "card": 2, "values": [[...], [...]],
+                  "evidence": ["Battery", "Ignition"], "evidence_card": [2, 2]}, ...]
+      }
+    }
+
+`questions` maps each question to the fact its answer is declared as; emitted
+messages that are not questions are diagnostics. `network` holds the Bayesian
+network and its CPDs; without it `create_bayesian_network()` is used.
+Regenerate the file from CarTroubleshootingSystem with:
+
+    python -m app.knowledge_file export [path]
+"""
+import json
+import os
+import sys
+from collections import namedtuple
+
+from app.decision_graph import DecisionGraph, Step
+
+
+FORMAT_VERSION = 1
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'knowledge_base.json')
+
+KnowledgeDocument = namedtuple('KnowledgeDocument', ['graph', 'symptoms', 'symptom_facts', 'network'])
+
+
+def network_to_spec(model):
+    return {
+        "edges": [list(edge) for edge in model.edges()],
+        "cpds": [
+            dict({"variable": cpd.variable, "card": int(cpd.variable_card),
+                  "values": cpd.get_values().tolist()},
+                 **({"evidence": list(cpd.variables[1:]),
+                     "evidence_card": [int(card) for card in cpd.cardinality[1:]]} if len(cpd.variables) > 1 else {}))
+            for cpd in model.get_cpds()
+        ],
+    }
+
+
+def build_bayesian_network(spec):
+    """
+    Builds and checks the BayesianNetwork described by a `network` section.
+    """
+    from pgmpy.models import BayesianNetwork
+    from pgmpy.factors.discrete import TabularCPD
+
+    model = BayesianNetwork([tuple(edge) for edge in spec["edges"]])
+    model.add_cpds(*[TabularCPD(variable=cpd["variable"], variable_card=cpd["card"], values=cpd["values"],
+                                evidence=cpd.get("evidence"), evidence_card=cpd.get("evidence_card"))
+                     for cpd in spec["cpds"]])
+    model.check_model()
+    return model
+
+
+def to_document(graph, symptoms, symptom_facts, model=None):
+    document = {
+        "format": FORMAT_VERSION,
+        "symptoms": {label: {"phrases": list(phrases), "fact": list(symptom_facts[label])}
+                     for label, phrases in symptoms.items()},
+        "questions": dict(graph.expected_facts),
+        "transitions": [
+            dict({"when": [fact, value]},
+                 **({"emit": list(step.questions)} if step.questions else {}),
+                 **({"declare": [list(pair) for pair in step.declares]} if step.declares else {}))
+            for (fact, value), step in sorted(graph.transitions.items())
+        ],
+    }
+    if model is not None:
+        document["network"] = network_to_spec(model)
+    return document
+
+
+def from_document(document):
+    """
+    Returns the KnowledgeDocument of a parsed knowledge-base file; `network` is None when absent.
+    """
+    if document.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported knowledge base format {document.get('format')!r}")
+    transitions = {}
+    for transition in document["transitions"]:
+        fact, value = transition["when"]
+        transitions[(fact, value)] = Step(tuple(transition.get("emit", ())),
+                                          tuple(tuple(pair) for pair in transition.get("declare", ())))
+    symptoms = {label: list(entry["phrases"]) for label, entry in document["symptoms"].items()}
+    symptom_facts = {label: tuple(entry["fact"]) for label, entry in document["symptoms"].items()}
+    return KnowledgeDocument(DecisionGraph(transitions, document["questions"]), symptoms, symptom_facts,
+                             document.get("network"))
+
+
+def load_knowledge_file(path=DEFAULT_PATH):
+    with open(path) as file:
+        return from_document(json.load(file))
+
+
+def export_knowledge_file(path=DEFAULT_PATH):
+    """
+    Writes the knowledge base compiled from CarTroubleshootingSystem and
+    create_bayesian_network() to `path`.
+    """
+    from app.car_troubleshooting import CarTroubleshootingSystem, SYMPTOM_FACTS, SYMPTOMS, create_bayesian_network
+    from app.decision_graph import compile_rules
+
+    document = to_document(compile_rules(CarTroubleshootingSystem), SYMPTOMS, SYMPTOM_FACTS,
+                           create_bayesian_network())
+    with open(path, "w") as file:
+        json.dump(document, file, indent=1, ensure_ascii=False)
+        file.write("\n")
+    return document
+
+
+def build_engine_class(graph):
+    """
+    Builds a KnowledgeEngine class with one rule per transition of `graph`, so
+    the experta engine mode runs the same knowledge base as the graph engine.
+    """
+    from experta import Rule
+    from app.car_troubleshooting import CarDiagnosis, DiagnosisEngine
+
+    def make_action(step):
+        def action(self):
+            for message in step.questions:
+                self.questions.append(message)
+                if message in graph.expected_facts:
+                    self.expected_facts[message] = graph.expected_facts[message]
+            for fact, value in step.declares:
+                self.declare(CarDiagnosis(**{fact: value}))
+        return action
+
+    rules = {f"rule_{index}": Rule(CarDiagnosis(**{fact: value}))(make_action(step))
+             for index, ((fact, value), step) in enumerate(sorted(graph.transitions.items()))}
+    return type('KnowledgeFileEngine', (DiagnosisEngine,), rules)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        sys.exit("usage: python -m app.knowledge_file export [path]")
+    export_knowledge_file(*sys.argv[2:3])
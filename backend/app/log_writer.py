@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+
+
+class ChatLogWriter:
+    """
+    Appends chat log lines to a file without blocking the request handlers.
+
+    `write()` only puts the line on a bounded in-memory queue. A background
+    thread drains it in batches, writing once `batch_size` lines are waiting
+    or `flush_interval` seconds have passed, keeps the file open between
+    batches and rotates it to `path.1`, `path.2`, ... once it grows past
+    `max_bytes`. Lines arriving while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, path="chat_logs.log", batch_size=256, flush_interval=1.0,
+                 max_bytes=10 * 1024 * 1024, backup_count=5, max_queue=100000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Flushes every queued line and stops the background thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            # Block until a line arrives, then batch whatever follows within the interval
+            line = self._queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while line is not None:
+                batch.append(line)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    line = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_batch(batch)
+            if line is None:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, lines):
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write("".join(lines))
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
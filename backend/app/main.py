@@ -1,13 +1,45 @@
+import asyncio
+import logging
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.endpoints import router  # Ajuste en la importación
-from app.car_troubleshooting import CarTroubleshootingChatbot
+from app.logging_config import configure_logging
+from app.endpoints import batch_replayer, chat_log, diagnosis_pool, router  # Ajuste en la importación
+from app.metrics import RequestMetricsMiddleware
 
+configure_logging()
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+def log_warmup_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Knowledge base warm-up failed", exc_info=task.exception())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Build the knowledge base in the background so the server answers health checks right away;
+    # /api/health/ready reports 503 until it is done. KNOWLEDGE_BASE_WARMUP=0 builds it on the first chat instead.
+    app.state.warmup = None
+    if os.environ.get('KNOWLEDGE_BASE_WARMUP', '1') != '0':
+        app.state.warmup = asyncio.create_task(diagnosis_pool.warm_up())
+        app.state.warmup.add_done_callback(log_warmup_failure)
+    yield
+    if app.state.warmup is not None:
+        app.state.warmup.cancel()
+    diagnosis_pool.shutdown()
+    batch_replayer.shutdown()
+    # Write out any chat log lines still queued
+    chat_log.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Latency of every request, exposed on /api/metrics
+app.add_middleware(RequestMetricsMiddleware)
 
 # Configurar CcleaORS
 app.add_middleware(
@@ -16,6 +48,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
 # Registrar las rutas de los endpoints
@@ -0,0 +1,220 @@
+from collections import OrderedDict, defaultdict, namedtuple
+import itertools
+import re
+import threading
+
+
+# `confidence` is 1.0 for exact matches, 1 - edits / len(phrase) for fuzzy ones
+Match = namedtuple('Match', ['label', 'phrase', 'span', 'confidence'], defaults=(1.0,))
+
+
+class PhraseMatcher:
+    """
+    Finds labelled phrases in a message with a single compiled regex scan.
+
+    Labels rank in the order of `phrases_by_label` and phrases in their order
+    within each list. `match()` returns the best ranked phrase found anywhere
+    in the message, the same one that testing each phrase in turn with `in`
+    would find first.
+    """
+
+    def __init__(self, phrases_by_label):
+        self._ranks = {}  # phrase -> (rank, label)
+        for label, phrases in phrases_by_label.items():
+            for phrase in phrases:
+                self._ranks.setdefault(phrase, (len(self._ranks), label))
+        # The lookahead reports a match at every position, including overlapping ones,
+        # and at each position the alternation tries phrases in rank order
+        alternation = '|'.join(re.escape(phrase) for phrase in self._ranks)
+        self._pattern = re.compile(f'(?=({alternation}))')
+
+    def match(self, message):
+        """
+        Returns the best ranked Match in `message`, or None.
+        """
+        best = None
+        for found in self._pattern.finditer(message):
+            rank, label = self._ranks[found.group(1)]
+            if best is None or rank < best[0]:
+                best = (rank, Match(label, found.group(1), found.span(1)))
+                if rank == 0:
+                    break
+        return best[1] if best else None
+
+
+def _trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _character_masks(pattern):
+    # Bit i of masks[c] is set when pattern[i] == c
+    masks = defaultdict(int)
+    for i, character in enumerate(pattern):
+        masks[character] |= 1 << i
+    return dict(masks)
+
+
+def _osa_distance(masks, length, text):
+    """
+    Optimal string alignment distance between the pattern of `masks` (of
+    `length` characters) and `text`: insertions, deletions, substitutions and
+    adjacent transpositions. Bit-parallel (Hyyrö), one step per character of
+    `text` for patterns of any length.
+    """
+    if not length:
+        return len(text)
+    full = (1 << length) - 1
+    last = 1 << (length - 1)
+    positive, negative = full, 0
+    diagonal, previous_match = 0, 0
+    distance = length
+    for character in text:
+        match = masks.get(character, 0)
+        transposed = (((~diagonal) & match) << 1) & previous_match
+        diagonal = ((((match & positive) + positive) ^ positive) | match | negative | transposed) & full
+        horizontal_positive = negative | ~(diagonal | positive)
+        horizontal_negative = diagonal & positive
+        if horizontal_positive & last:
+            distance += 1
+        elif horizontal_negative & last:
+            distance -= 1
+        shifted = ((horizontal_positive << 1) | 1) & full
+        negative = shifted & diagonal
+        positive = ((horizontal_negative << 1) | ~(shifted | diagonal)) & full
+        previous_match = match
+    return distance
+
+
+def edit_distance(a, b):
+    """
+    Optimal string alignment distance between `a` and `b`.
+    """
+    return _osa_distance(_character_masks(a), len(a), b)
+
+
+class FuzzyPhraseMatcher:
+    """
+    Typo-tolerant phrase matching ("car wont strt", "braks"), meant as a
+    fallback once PhraseMatcher found nothing.
+
+    Every word of the message is first corrected to the words of the
+    vocabulary within a bounded edit distance, using a prebuilt trigram index
+    over the distinct words of all phrases, then runs of corrected words are
+    walked down a trie of the phrases. A phrase matches when its confidence,
+    `1 - edits / len(phrase)` summed over its words, reaches `threshold`.
+    Only the number of distinct words affects a lookup, not the number of
+    phrases, and the corrections of the `cache_size` most recently seen
+    words are memoized. Only the first `max_tokens` words of a message are
+    looked at, so a long message costs no more than a short one. Phrases are
+    compared as the chatbot cleans messages: lowercase and without
+    punctuation.
+    """
+
+    # Longer words still only get two typos, as more would mostly match other words
+    MAX_EDITS = 2
+
+    def __init__(self, phrases_by_label, threshold=0.8, cache_size=4096, max_tokens=32):
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.max_tokens = max_tokens
+        self._trie = {}  # word -> child node; the None key holds (rank, label, phrase) where a phrase ends
+        words = {}
+        rank = 0
+        for label, phrases in phrases_by_label.items():
+            for phrase in phrases:
+                phrase = ' '.join(re.sub(r'[^\w\s]', '', phrase.lower()).split())
+                node = self._trie
+                for word in phrase.split():
+                    node = node.setdefault(word, {})
+                    words.setdefault(word, len(words))
+                if phrase and None not in node:
+                    node[None] = (rank, label, phrase)
+                    rank += 1
+
+        self._vocabulary = words
+        # Tokens longer than this are too far from every word to be corrected
+        self._max_length = max((len(word) for word in words), default=0) + self.MAX_EDITS
+        # word id -> (word, allowed edits, trigrams, trigrams needed, character masks)
+        self._words = []
+        for word in words:
+            edits = min(self.MAX_EDITS, int((1 - threshold) * len(word) + 1e-9))
+            trigrams = _trigrams(word)
+            self._words.append((word, edits, trigrams, len(trigrams) - 3 * edits, _character_masks(word)))
+        # Each edit changes at most three trigrams, so a word within its allowed edits shares
+        # at least one of its `3 * edits + 1` rarest trigrams; only those are indexed, next to
+        # the word's length as a typo changes it by at most its number of edits
+        frequency = defaultdict(int)
+        for _, _, trigrams, _, _ in self._words:
+            for trigram in trigrams:
+                frequency[trigram] += 1
+        self._index = defaultdict(list)  # (length, trigram) -> ids of the words indexed under it
+        self._unfiltered = []  # ids of words that may match without sharing any trigram
+        for word_id, (_, edits, trigrams, needed, _) in enumerate(self._words):
+            if edits < 1:
+                continue
+            if needed < 1:
+                self._unfiltered.append(word_id)
+                continue
+            for trigram in sorted(trigrams, key=lambda trigram: (frequency[trigram], trigram))[:len(trigrams) - needed + 1]:
+                self._index[(len(self._words[word_id][0]), trigram)].append(word_id)
+        self._corrections = OrderedDict()  # token -> corrections, least recently used first
+        self._lock = threading.Lock()
+
+    def corrections(self, token):
+        """
+        Returns the `(word, edits)` pairs of the vocabulary words `token` may be a typo of, itself included.
+        """
+        if len(token) > self._max_length:
+            return ()
+        with self._lock:
+            found = self._corrections.get(token)
+            if found is not None:
+                self._corrections.move_to_end(token)
+                return found
+        found = [(token, 0)] if token in self._vocabulary else []
+        token_trigrams = _trigrams(token)
+        candidates = set(self._unfiltered)
+        for length in range(len(token) - self.MAX_EDITS, len(token) + self.MAX_EDITS + 1):
+            for trigram in token_trigrams:
+                candidates.update(self._index.get((length, trigram), ()))
+        for word_id in candidates:
+            word, edits, trigrams, needed, masks = self._words[word_id]
+            if word == token or abs(len(word) - len(token)) > edits or len(trigrams & token_trigrams) < needed:
+                continue
+            distance = _osa_distance(masks, len(word), token)
+            if distance <= edits:
+                found.append((word, distance))
+        found = tuple(found)
+        with self._lock:
+            self._corrections[token] = found
+            while len(self._corrections) > self.cache_size:
+                self._corrections.popitem(last=False)
+        return found
+
+    def match(self, message):
+        """
+        Returns the Match with the highest confidence (ties go to the better
+        ranked phrase), or None.
+        """
+        tokens = [(found.group(), found.span())
+                  for found in itertools.islice(re.finditer(r'\S+', message), self.max_tokens)]
+        alternatives = [self.corrections(token) for token, _ in tokens]
+        best = None
+        for start in range(len(tokens)):
+            pending = [(self._trie, start, 0)]
+            while pending:
+                node, position, edits = pending.pop()
+                ending = node.get(None)
+                if ending is not None:
+                    rank, label, phrase = ending
+                    confidence = 1 - edits / len(phrase)
+                    if confidence >= self.threshold and (best is None or (confidence, -rank) > (best[0], -best[1])):
+                        best = (confidence, rank, Match(label, phrase, (tokens[start][1][0], tokens[position - 1][1][1]),
+                                                        confidence))
+                if position < len(tokens):
+                    for word, distance in alternatives[position]:
+                        child = node.get(word)
+                        if child is not None:
+                            pending.append((child, position + 1, edits + distance))
+        return best[2] if best else None
@@ -0,0 +1,234 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Every metric created here, in exposition order
+REGISTRY = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    """
+    Minimal Prometheus-style histogram with cumulative buckets per label set.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labelvalues, values in sorted(series.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', repr(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {values[-1]}")
+        return lines
+
+
+class Counter:
+    """
+    Minimal Prometheus-style counter per label set.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}  # label values -> count
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._series[labelvalues] = self._series.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._series.get(labelvalues, 0)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for labelvalues, count in sorted(series.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, labelvalues)))} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    Minimal Prometheus-style gauge read when rendered: the function given to
+    `set_function()` returns the current value of every label set as a dict.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._function = dict
+        REGISTRY.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self, *labelvalues):
+        return self._function().get(labelvalues, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labelvalues, value in sorted(self._function().items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, labelvalues)))} {value}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_duration_seconds", "Latency of HTTP requests.", ["method", "path", "status"])
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_duration_seconds", "Time spent in each stage of a chat turn.", ["stage"])
+OPENER_CACHE_LOOKUPS = Counter(
+    "chatbot_opener_cache_lookups_total", "Conversation openers served from the cache (hit) or computed (miss).",
+    ["result"])
+OPENER_CACHE_EVICTIONS = Counter(
+    "chatbot_opener_cache_evictions_total", "Cached openers evicted to stay within the cache size.")
+SESSION_EVICTIONS = Counter(
+    "chatbot_session_evictions_total",
+    "In-memory sessions evicted for being idle (expired), over SESSION_MAX (count) or over SESSION_MAX_BYTES (memory).",
+    ["reason"])
+ENGINE_POOL_CHECKOUTS = Counter(
+    "chatbot_engine_pool_checkouts_total",
+    "Rule engines handed to a conversation from the pool (reused) or built because it was empty (built).", ["result"])
+ENGINE_POOL_DISCARDS = Counter(
+    "chatbot_engine_pool_discards_total",
+    "Rule engines dropped on return because the pool was full (full) or could not be reset (dirty).", ["reason"])
+ENGINE_POOL_ENGINES = Gauge(
+    "chatbot_engine_pool_engines", "Rule engines waiting in the pool (idle) or held by a conversation (in_use).",
+    ["state"])
+
+# Callables receiving (stage, seconds) for every timed stage, e.g. benchmarks
+_stage_listeners = []
+
+
+def add_stage_listener(listener):
+    _stage_listeners.append(listener)
+
+
+def remove_stage_listener(listener):
+    _stage_listeners.remove(listener)
+
+
+@contextmanager
+def collected_stages():
+    """
+    Collects the `(stage, seconds)` pairs timed in the block into the list it
+    yields, e.g. to hand them to another process with record_stages().
+    """
+    stages = []
+    listener = lambda stage, seconds: stages.append((stage, seconds))
+    add_stage_listener(listener)
+    try:
+        yield stages
+    finally:
+        remove_stage_listener(listener)
+
+
+def record_stages(stages):
+    """
+    Records stage timings collected elsewhere, as if they were timed here.
+    """
+    for stage, seconds in stages:
+        STAGE_SECONDS.observe(seconds, stage)
+        for listener in _stage_listeners:
+            listener(stage, seconds)
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Records the time spent in the block under `stage` (matching, rules, inference).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        for listener in _stage_listeners:
+            listener(stage, elapsed)
+
+
+def render_metrics():
+    """
+    Returns every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every HTTP request in REQUEST_SECONDS.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Label by route template so ids in the URL do not create new series
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path, str(status[0]))
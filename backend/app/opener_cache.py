@@ -0,0 +1,60 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from app.metrics import OPENER_CACHE_EVICTIONS, OPENER_CACHE_LOOKUPS
+
+
+# What a symptom opener does to a conversation: the reply, the registry id of the question it
+# leaves pending (None when there is none), the rule engine's facts, the
+# questions still queued and whether the evidence is cleared
+Opener = namedtuple('Opener', ['reply', 'question', 'facts', 'queued', 'resets_evidence'])
+
+
+class OpenerCache:
+    """
+    Bounded LRU cache of conversation openers, keyed by the cleaned message,
+    the knowledge-base version and the engine mode.
+
+    An opener (a message naming a symptom) gets the same reply and leaves
+    the conversation in the same state whatever came before, so it can be
+    replayed from here instead of matching phrases and running the rules.
+    Lookups are counted in OPENER_CACHE_LOOKUPS: a 'hit' is served from the
+    cache and a 'miss' is an opener computed and stored.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            opener = self._entries.get(key)
+            if opener is not None:
+                self._entries.move_to_end(key)
+        if opener is not None:
+            OPENER_CACHE_LOOKUPS.inc('hit')
+        return opener
+
+    def put(self, key, opener):
+        OPENER_CACHE_LOOKUPS.inc('miss')
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = opener
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                OPENER_CACHE_EVICTIONS.inc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every conversation in the process; OPENER_CACHE_SIZE=0 disables it
+opener_cache = OpenerCache(maxsize=int(os.environ.get('OPENER_CACHE_SIZE', '1024')))
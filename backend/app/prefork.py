@@ -0,0 +1,121 @@
+"""
+Preforking server launcher.
+
+`uvicorn app.main:app --workers N` starts every worker from a fresh
+interpreter, so each one imports the app and builds its own knowledge base.
+This launcher does that once in a master process, freezes the result out of
+the garbage collector's reach and then forks the workers, which start ready
+and share those pages with the master copy-on-write. The master only
+supervises: it restarts workers that die and stops them all on SIGTERM or
+SIGINT. Needs os.fork (Linux, macOS).
+
+    python -m app.prefork --workers 4 --host 0.0.0.0 --port 8000
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is restarted after a pause, not in a tight loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def preload(engine_mode=None):
+    """
+    Imports the app and does the warm-up of every worker once: the knowledge
+    base, the opener cache and, in 'experta' mode, the engine pool. The
+    objects alive afterwards are moved to the permanent generation with
+    gc.freeze(), so collections in the workers never write to (and copy) the
+    pages they share with the master. Returns the ASGI app.
+    """
+    # The knowledge-base watcher is a thread, which a fork does not carry over: each worker starts its own
+    watch_interval = os.environ.pop('KNOWLEDGE_BASE_WATCH_INTERVAL', None)
+    try:
+        from app.main import app
+        from app.chatbot import warm_up
+        warm_up(engine_mode)
+    finally:
+        if watch_interval is not None:
+            os.environ['KNOWLEDGE_BASE_WATCH_INTERVAL'] = watch_interval
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+def _fork_worker(config, sock):
+    import uvicorn
+
+    pid = os.fork()
+    if pid:
+        return pid
+    # uvicorn installs its own handlers for a graceful shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+    except BaseException:
+        logger.exception("Worker failed")
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def serve(workers=1, host="127.0.0.1", port=8000, engine_mode=None):
+    """
+    Preloads the app, binds the listening socket and runs `workers` forked
+    uvicorn workers on it until the master is told to stop.
+    """
+    import uvicorn
+
+    config = uvicorn.Config(preload(engine_mode), host=host, port=port, lifespan="on")
+    sock = config.bind_socket()
+    children = {}  # pid -> time it was forked
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        children[_fork_worker(config, sock)] = time.monotonic()
+    logger.info("Preforked workers", extra={"workers": workers, "pids": sorted(children)})
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning("Worker exited, restarting it", extra={"pid": pid, "exit_code": os.waitstatus_to_exitcode(status)})
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        if not stopping:
+            children[_fork_worker(config, sock)] = time.monotonic()
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "1")))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+    serve(args.workers, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Dense integer ids for the questions and facts of a knowledge base.
+
+Ids follow the sorted texts, so two processes loading the same knowledge base
+agree on them; `fingerprint` tells whether ids written by another process can
+be read back. Texts the registry does not know (a free-form answer, a
+question from an engine outside the graph) are passed through as they are.
+"""
+import zlib
+
+
+# Answers that fact ids can carry, as `fact id * 2 + index`
+VALUES = ('no', 'yes')
+
+
+class Registry:
+    """
+    Question and fact ids of one DecisionGraph. `evidence_questions` lists the
+    questions that feed the Bayesian network, in the order of their evidence
+    slots.
+    """
+
+    def __init__(self, graph, evidence_questions=()):
+        messages = set(graph.expected_facts)
+        facts = set(graph.expected_facts.values())
+        for (fact, _), step in graph.transitions.items():
+            facts.add(fact)
+            messages.update(step.questions)
+            facts.update(declared for declared, _ in step.declares)
+        self.questions = tuple(sorted(messages))
+        self.question_ids = {question: index for index, question in enumerate(self.questions)}
+        self.facts = tuple(sorted(facts))
+        self.fact_ids = {fact: index for index, fact in enumerate(self.facts)}
+        # question id -> fact its answer is declared as (None when it takes no answer)
+        self.expected_fact = tuple(graph.expected_facts.get(question) for question in self.questions)
+        # question id -> evidence slot (-1 when it feeds no evidence)
+        slots = {question: slot for slot, question in enumerate(evidence_questions)}
+        self.evidence_slot = tuple(slots.get(question, -1) for question in self.questions)
+        self.fingerprint = format(zlib.crc32('\n'.join(self.questions + ('',) + self.facts).encode()), '08x')
+
+    def encode_question(self, question):
+        return self.question_ids.get(question, question) if question is not None else None
+
+    def decode_question(self, question):
+        return self.questions[question] if type(question) is int else question
+
+    def encode_fact(self, fact, value):
+        fact_id = self.fact_ids.get(fact)
+        if fact_id is None or value not in VALUES:
+            return [fact, value]
+        return fact_id * 2 + VALUES.index(value)
+
+    def decode_fact(self, fact):
+        if type(fact) is int:
+            return [self.facts[fact >> 1], VALUES[fact & 1]]
+        return list(fact)
@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """
+    Keeps serialized sessions in a dict; only shared by the threads of one process.
+    """
+
+    def __init__(self, ttl=1800, max_sessions=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._data = OrderedDict()  # session_id -> (data, expires)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del self._data[session_id]
+                return None
+            return entry[0]
+
+    def save(self, session_id, data):
+        with self._lock:
+            self._data[session_id] = (data, self.clock() + self.ttl)
+            self._data.move_to_end(session_id)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def nbytes(self):
+        # Serialized sessions only; ids and dict entries are not counted
+        with self._lock:
+            return sum(len(data) for data, _ in self._data.values())
+
+
+class SQLiteBackend:
+    """
+    Keeps serialized sessions in an SQLite file that every worker process on the host can open.
+
+    SQLite connections cannot be used across a fork, so each process opens
+    its own on first use, including workers forked after the backend was
+    built (see app.prefork).
+    """
+
+    # Expired rows are deleted once every this many saves
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl=1800, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._saves = 0
+        self._pid = None
+        self._connection = None
+        # Connections opened by a parent process; kept referenced so the child never closes them
+        self._inherited = []
+
+    @property
+    def connection(self):
+        # Called with _lock held
+        if self._pid != os.getpid():
+            if self._connection is not None:
+                self._inherited.append(self._connection)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sessions WHERE expires > ?",
+                                            (self.clock(),)).fetchone()[0]
+
+    def load(self, session_id):
+        with self._lock:
+            row = self.connection.execute("SELECT data FROM sessions WHERE id = ? AND expires > ?",
+                                           (session_id, self.clock())).fetchone()
+        return bytes(row[0]) if row else None
+
+    def save(self, session_id, data):
+        with self._lock:
+            now = self.clock()
+            self.connection.execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                                     (session_id, data, now + self.ttl))
+            self._saves += 1
+            if self._saves % self.PURGE_EVERY == 0:
+                self.connection.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def delete(self, session_id):
+        with self._lock:
+            self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM sessions")
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._connection.close()
+            elif self._connection is not None:
+                self._inherited.append(self._connection)
+            self._connection = None
+            self._pid = None
+
+
+class RedisBackend:
+    """
+    Keeps serialized sessions in Redis (or anything speaking its protocol), with
+    the TTL enforced by the server. `client` only needs get, set(ex=), delete
+    and scan_iter, as provided by redis.Redis.
+    """
+
+    def __init__(self, client, ttl=1800, prefix="session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis session backend needs the 'redis' package (pip install redis)")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+
+    def load(self, session_id):
+        return self.client.get(self.prefix + session_id)
+
+    def save(self, session_id, data):
+        self.client.set(self.prefix + session_id, data, ex=max(1, int(self.ttl)))
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+    def clear(self):
+        for key in list(self.client.scan_iter(match=self.prefix + "*")):
+            self.client.delete(key)
@@ -0,0 +1,295 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.metrics import SESSION_EVICTIONS
+
+
+SESSION_HEADER = "X-Session-Id"
+SESSION_COOKIE = "session_id"
+MAX_SESSION_ID_LENGTH = 128
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def resolve_session_id(headers, cookies):
+    """
+    Returns the session id sent by the client (header first, then cookie),
+    or None when the client did not send a usable one.
+    """
+    session_id = headers.get(SESSION_HEADER) or cookies.get(SESSION_COOKIE)
+    if session_id and len(session_id) <= MAX_SESSION_ID_LENGTH:
+        return session_id
+    return None
+
+
+class SessionStore:
+    """
+    Bounded in-memory store holding one conversation state per session id.
+
+    Sessions are kept in least-recently-used order: once `max_sessions` is
+    reached the oldest one is evicted, and sessions idle for longer than
+    `ttl` seconds are dropped on the next access to the store.
+    """
+
+    def __init__(self, factory, max_sessions=10000, ttl=1800, clock=time.monotonic):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.clock = clock
+        self._sessions = OrderedDict()  # session_id -> (state, last_seen)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        """
+        Returns the state of a live session, or None if it does not exist or expired.
+        """
+        with self._lock:
+            now = self.clock()
+            self._evict_expired(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], now)
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def get_or_create(self, session_id=None):
+        """
+        Returns `(session_id, state)`, creating a fresh state (and id if needed)
+        when the session is unknown.
+        """
+        with self._lock:
+            now = self.clock()
+            self._evict_expired(now)
+            if session_id is None:
+                session_id = new_session_id()
+            entry = self._sessions.get(session_id)
+            state = entry[0] if entry is not None else self.factory()
+            self._sessions[session_id] = (state, now)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                SESSION_EVICTIONS.inc('count')
+            return session_id, state
+
+    def save(self, session_id, state):
+        # States are kept as live objects, so changes made during a turn are already stored
+        pass
+
+    def stats(self):
+        # Live objects are not measured
+        return {"store": "live", "sessions": len(self._sessions), "bytes": None}
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def _evict_expired(self, now):
+        # The dict is ordered by last access, so expired sessions are at the front
+        while self._sessions:
+            session_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if now - last_seen <= self.ttl:
+                break
+            del self._sessions[session_id]
+            SESSION_EVICTIONS.inc('expired')
+
+
+class CompactSessionStore:
+    """
+    In-memory session store keeping each conversation as a compact snapshot
+    between turns instead of a live chatbot with its rule engine.
+
+    `get_or_create()` rebuilds the chatbot with `factory()` and `restore()`,
+    and `save()` stores `compact()` back and lets the chatbot `release()`
+    what it borrowed for the turn. Snapshots are kept in
+    least-recently-used order and evicted past `max_sessions`, past `ttl`
+    seconds idle or, when `max_bytes` is set, while the memory they account
+    for exceeds it. `bytes` is that accounting: the snapshots' own `nbytes()`
+    plus the session id and the store's entry for it.
+    """
+
+    # Measured cost of one entry in `_sessions` besides the snapshot and its id:
+    # the OrderedDict slot and link, the entry tuple and the last-seen float
+    ENTRY_BYTES = 200
+
+    def __init__(self, factory, max_sessions=10000, ttl=1800, max_bytes=0, clock=time.monotonic):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.bytes = 0
+        self._sessions = OrderedDict()  # session_id -> (snapshot, last_seen, bytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        """
+        Returns the rebuilt state of a live session, or None if it does not exist or expired.
+        """
+        with self._lock:
+            now = self.clock()
+            self._evict_expired(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], now, entry[2])
+            self._sessions.move_to_end(session_id)
+        state = self.factory()
+        state.restore(entry[0])
+        return state
+
+    def get_or_create(self, session_id=None):
+        if session_id is None:
+            session_id = new_session_id()
+        state = self.get(session_id)
+        return session_id, state if state is not None else self.factory()
+
+    def save(self, session_id, state):
+        snapshot = state.compact()
+        state.release()
+        size = snapshot.nbytes() + sys.getsizeof(session_id) + self.ENTRY_BYTES
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._sessions[session_id] = (snapshot, self.clock(), size)
+            self.bytes += size
+            while len(self._sessions) > self.max_sessions:
+                self._pop_oldest('count')
+            # The session just saved is kept even if it alone is over the cap
+            while self.max_bytes and self.bytes > self.max_bytes and len(self._sessions) > 1:
+                self._pop_oldest('memory')
+
+    def delete(self, session_id):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            self._evict_expired(self.clock())
+            return {"store": "compact", "sessions": len(self._sessions), "bytes": self.bytes,
+                    "max_sessions": self.max_sessions, "max_bytes": self.max_bytes or None}
+
+    def _pop_oldest(self, reason):
+        _, entry = self._sessions.popitem(last=False)
+        self.bytes -= entry[2]
+        SESSION_EVICTIONS.inc(reason)
+
+    def _evict_expired(self, now):
+        while self._sessions:
+            last_seen = next(iter(self._sessions.values()))[1]
+            if now - last_seen <= self.ttl:
+                break
+            self._pop_oldest('expired')
+
+
+def encode_state(state):
+    return json.dumps(state, separators=(",", ":")).encode()
+
+
+def decode_state(data):
+    return json.loads(data)
+
+
+class SerializedSessionStore:
+    """
+    Session store keeping every conversation serialized in a backend (see
+    app.session_backends), so any worker process can serve any turn.
+
+    States are rebuilt with `factory()` and `load_state()` when a turn starts
+    and written back with `dump_state()` by `save()` when it ends, which also
+    lets the chatbot `release()` what it borrowed for the turn; the backend
+    applies its own TTL.
+    """
+
+    def __init__(self, factory, backend):
+        self.factory = factory
+        self.backend = backend
+
+    def __len__(self):
+        return len(self.backend)
+
+    def __contains__(self, session_id):
+        return self.backend.load(session_id) is not None
+
+    def get(self, session_id):
+        data = self.backend.load(session_id)
+        if data is None:
+            return None
+        state = self.factory()
+        state.load_state(decode_state(data))
+        return state
+
+    def get_or_create(self, session_id=None):
+        if session_id is None:
+            session_id = new_session_id()
+        state = self.get(session_id)
+        return session_id, state if state is not None else self.factory()
+
+    def save(self, session_id, state):
+        data = encode_state(state.dump_state())
+        state.release()
+        self.backend.save(session_id, data)
+
+    def delete(self, session_id):
+        self.backend.delete(session_id)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        # The backend is shared by every worker, and only the memory one knows its size
+        return {"store": type(self.backend).__name__, "sessions": len(self.backend),
+                "bytes": getattr(self.backend, "nbytes", lambda: None)(), "shared": True}
+
+
+def create_session_store(factory):
+    """
+    Builds the session store selected by SESSION_BACKEND: 'memory' (the default,
+    one process only, capped by SESSION_MAX and SESSION_MAX_BYTES), 'sqlite' (SESSION_SQLITE_PATH) or
+    'redis' (SESSION_REDIS_URL).
+    """
+    from app.session_backends import RedisBackend, SQLiteBackend
+
+    backend = os.environ.get("SESSION_BACKEND", "memory")
+    max_sessions = int(os.environ.get("SESSION_MAX", "10000"))
+    ttl = float(os.environ.get("SESSION_TTL_SECONDS", "1800"))
+    if backend == "memory":
+        return CompactSessionStore(factory, max_sessions=max_sessions, ttl=ttl,
+                                   max_bytes=int(os.environ.get("SESSION_MAX_BYTES", "0")))
+    if backend == "sqlite":
+        return SerializedSessionStore(factory, SQLiteBackend(os.environ.get("SESSION_SQLITE_PATH", "sessions.db"), ttl=ttl))
+    if backend == "redis":
+        url = os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0")
+        return SerializedSessionStore(factory, RedisBackend.from_url(url, ttl=ttl))
+    raise ValueError(f"Unknown session backend {backend!r}, expected memory, sqlite or redis")
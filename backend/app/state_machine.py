@@ -0,0 +1,319 @@
+"""
+Materialized conversation state machine for the 'graph' engine mode.
+
+Between turns a 'graph' conversation is a small, finite state: the pending
+question, the facts of the current diagnosis, the queued questions and the
+evidence vector. `build_state_machine()` replays every state reachable from
+a new conversation on a real chatbot, for every symptom and every kind of
+answer, then merges the states that no sequence of messages can tell apart
+(keeping the pending question and the evidence exact). `write_state_machine()`
+lays the result out as a flat binary file and StateMachine maps it, so a turn
+is two struct lookups into pages every worker shares, with no rule engine or
+Bayesian network involved:
+
+    python -m app.state_machine build [path]
+
+The file records a digest of the knowledge-base file and of the code that
+produces the replies, and is ignored (with a warning) when either changed.
+Answers are taken as 'yes', 'no' or anything else; facts answered with
+anything else never fire a rule, so they are not kept in the states.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CARSTATE'
+FORMAT_VERSION = 1
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'knowledge_base.states')
+# Modules whose code decides the replies stored in the file
+SOURCES = ('chatbot.py', 'decision_graph.py', 'inference.py', 'state_machine.py')
+
+EVENTS = ('question', 'diagnostic', 'message')
+ANSWER_VALUES = ('yes', 'no')
+# Message standing for every answer other than ANSWER_VALUES while building
+OTHER_ANSWER = ''
+NO_NODE = -1
+NO_TEXT = 0xFFFFFFFF
+
+# magic, format, digest, nodes, symptom labels, answers, strings, evidence slots, id pool length
+HEADER = struct.Struct('<8sI20sIIIIII')
+# pending question id (-1 for none), facts and queued questions as (offset, count) in the id pool, evidence
+NODE = '<iIHIH{}s'
+# successor node, reply string, probability string (NO_TEXT for none), reply event
+EDGE = struct.Struct('<iIIB')
+
+
+def machine_digest(knowledge_base):
+    """
+    Returns the digest a state machine built for `knowledge_base` carries, or
+    None when the knowledge base was not loaded from a file.
+    """
+    if knowledge_base.digest is None:
+        return None
+    digest = hashlib.sha1(knowledge_base.digest.encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        with open(os.path.join(directory, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.digest()
+
+
+class MaterializedStates:
+    """
+    A state machine as built, before it is written: `symbols` are the symptom
+    labels followed by ANSWER_VALUES and OTHER_ANSWER, `edges[node][symbol]`
+    is `(successor, event, reply, probability)` or None, and `states[node]`
+    is `(question, facts, queued, evidence)` with registry ids. Node 0 is a
+    new conversation.
+    """
+
+    def __init__(self, digest, labels, states, edges):
+        self.digest = digest
+        self.labels = labels
+        self.symbols = tuple(labels) + ANSWER_VALUES + (OTHER_ANSWER,)
+        self.states = states
+        self.edges = edges
+
+
+def _symptom_messages(knowledge_base):
+    # One message per symptom that the matcher takes for that symptom
+    messages = {}
+    for label, phrases in knowledge_base.symptoms.items():
+        for phrase in phrases:
+            match = knowledge_base.symptom_matcher.match(phrase)
+            if match is not None and match.label == label:
+                messages[label] = phrase
+                break
+        else:
+            raise ValueError(f"No phrase of symptom {label!r} is matched as that symptom")
+    return messages
+
+
+def build_state_machine(knowledge_base):
+    """
+    Explores every conversation state of `knowledge_base` in 'graph' mode and
+    returns the minimized MaterializedStates.
+    """
+    from app.chatbot import NO_EVIDENCE, CarTroubleshootingChatbot, ConversationState
+
+    digest = machine_digest(knowledge_base)
+    if digest is None:
+        raise ValueError("Only a knowledge base loaded from a file can be materialized")
+    graph, registry = knowledge_base.graph, knowledge_base.registry
+    if any(value not in ANSWER_VALUES for _, value in graph.transitions):
+        raise ValueError(f"Rules matching answers other than {ANSWER_VALUES} cannot be materialized")
+    # Facts that fire a rule; the others do nothing but sit in working memory
+    firing = {registry.encode_fact(fact, value) for fact, value in graph.transitions}
+    messages = _symptom_messages(knowledge_base)
+    labels = tuple(messages)
+    inputs = [messages[label] for label in labels] + list(ANSWER_VALUES) + [OTHER_ANSWER]
+
+    def state_of(chatbot):
+        state = chatbot.compact()
+        if type(state.question) not in (int, type(None)) or any(type(question) is not int for question in state.queued):
+            raise ValueError("Questions outside the registry cannot be materialized")
+        return (state.question, tuple(sorted(fact for fact in state.facts if type(fact) is int and fact in firing)),
+                tuple(state.queued), bytes(state.evidence))
+
+    start = (None, (), (), NO_EVIDENCE)
+    index, states, edges = {start: 0}, [start], []
+    for question, facts, queued, evidence in states:
+        row = []
+        for symbol, message in enumerate(inputs):
+            if symbol >= len(labels) and question is None:
+                row.append(None)  # Answers only reach the rules while a question is pending
+                continue
+            chatbot = CarTroubleshootingChatbot('graph', knowledge_base)
+            # Explore the rules themselves, not a machine built before
+            chatbot.state_machine = None
+            chatbot.restore(ConversationState(knowledge_base, question, facts, queued, evidence))
+            events = list(chatbot.diagnose_events(message))
+            (event, reply), probability = events[0], events[1][1] if len(events) > 1 else None
+            successor = state_of(chatbot)
+            if successor not in index:
+                index[successor] = len(states)
+                states.append(successor)
+            row.append((index[successor], event, reply, probability))
+        edges.append(row)
+    return _minimize(MaterializedStates(digest, labels, states, edges))
+
+
+def _minimize(machine):
+    # Moore's partition refinement: states start apart by what they show and
+    # reply, and split until the successors of each block agree too
+    def renumber(signatures):
+        numbers = {}
+        return [numbers.setdefault(signature, len(numbers)) for signature in signatures]
+
+    blocks = renumber((state[0], state[3], tuple(edge and edge[1:] for edge in row))
+                      for state, row in zip(machine.states, machine.edges))
+    while True:
+        refined = renumber((blocks[node], tuple(edge and blocks[edge[0]] for edge in row))
+                           for node, row in enumerate(machine.edges))
+        if max(refined) == max(blocks):
+            break
+        blocks = refined
+    # Blocks are numbered by their first state in exploration order, so a new conversation stays node 0
+    first = {}
+    for node, block in enumerate(blocks):
+        first.setdefault(block, node)
+    states = [machine.states[node] for node in first.values()]
+    edges = [[edge and (blocks[edge[0]],) + edge[1:] for edge in machine.edges[node]] for node in first.values()]
+    return MaterializedStates(machine.digest, machine.labels, states, edges)
+
+
+def write_state_machine(machine, path=DEFAULT_PATH):
+    """
+    Writes MaterializedStates to `path`. The file is replaced rather than
+    rewritten, so servers mapping the previous one keep reading it intact.
+    """
+    strings, string_ids = [], {}
+
+    def string_id(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text.encode('utf-8'))
+        return string_ids[text]
+
+    evidence_length = len(machine.states[0][3])
+    node_struct = struct.Struct(NODE.format(evidence_length))
+    pool = array('H')
+    nodes = []
+    for question, facts, queued, evidence in machine.states:
+        nodes.append(node_struct.pack(NO_NODE if question is None else question,
+                                      len(pool), len(facts), len(pool) + len(facts), len(queued), evidence))
+        pool.extend(facts)
+        pool.extend(queued)
+    edges = []
+    for row in machine.edges:
+        for edge in row:
+            if edge is None:
+                edges.append(EDGE.pack(NO_NODE, NO_TEXT, NO_TEXT, 0))
+            else:
+                successor, event, reply, probability = edge
+                edges.append(EDGE.pack(successor, string_id(reply),
+                                       NO_TEXT if probability is None else string_id(probability), EVENTS.index(event)))
+    names = array('I', [string_id(text) for text in machine.labels + ANSWER_VALUES])
+    offsets = array('I', [0])
+    for data in strings:
+        offsets.append(offsets[-1] + len(data))
+    if sys.byteorder != 'little':
+        for values in (pool, names, offsets):
+            values.byteswap()
+
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, machine.digest, len(nodes), len(machine.labels),
+                               len(ANSWER_VALUES), len(strings), evidence_length, len(pool)))
+        file.write(names.tobytes())
+        file.write(b''.join(nodes))
+        file.write(b''.join(edges))
+        file.write(pool.tobytes())
+        file.write(offsets.tobytes())
+        file.write(b''.join(strings))
+    os.replace(temporary, path)
+
+
+class StateMachine:
+    """
+    A state machine file mapped read-only. Nodes and transitions are read in
+    place with struct; only the texts handed out are decoded.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, version, self.digest, self.node_count, label_count, answer_count, string_count, evidence_length, \
+            pool_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a state machine file of format {FORMAT_VERSION}")
+        self._node = struct.Struct(NODE.format(evidence_length))
+        self.symbol_count = label_count + answer_count + 1
+        offset = HEADER.size
+        names = struct.unpack_from(f'<{label_count + answer_count}I', self._map, offset)
+        offset += 4 * len(names)
+        self._nodes = offset
+        self._edges = self._nodes + self.node_count * self._node.size
+        self._pool = self._edges + self.node_count * self.symbol_count * EDGE.size
+        self._string_offsets = self._pool + 2 * pool_length
+        self._strings = self._string_offsets + 4 * (string_count + 1)
+        if len(self._map) != self._strings + struct.unpack_from('<I', self._map, self._strings - 4)[0]:
+            raise ValueError(f"{path} is truncated")
+        # Symbols of the symptom labels, then of the answers
+        self.labels = {self.text(name): symbol for symbol, name in enumerate(names[:label_count])}
+        self.answers = {self.text(name): label_count + index for index, name in enumerate(names[label_count:])}
+        self.other_answer = self.symbol_count - 1
+
+    def __len__(self):
+        return self.node_count
+
+    def text(self, index):
+        start, end = struct.unpack_from('<II', self._map, self._string_offsets + 4 * index)
+        return str(self._view[self._strings + start:self._strings + end], 'utf-8')
+
+    def answer_symbol(self, message):
+        return self.answers.get(message, self.other_answer)
+
+    def question(self, node):
+        question = struct.unpack_from('<i', self._map, self._nodes + node * self._node.size)[0]
+        return None if question == NO_NODE else question
+
+    def state(self, node):
+        """
+        Returns the `(question, facts, queued, evidence)` a node was built
+        from, with registry ids and the evidence as one byte per slot.
+        """
+        question, facts_at, facts, queued_at, queued, evidence = self._node.unpack_from(
+            self._map, self._nodes + node * self._node.size)
+        ids = struct.unpack_from(f'<{facts + queued}H', self._map, self._pool + 2 * facts_at)
+        return None if question == NO_NODE else question, ids[:facts], ids[facts:], evidence
+
+    def step(self, node, symbol):
+        """
+        Returns `(successor, event, reply, probability)` for `symbol` in
+        `node`; `probability` is None when the reply has no annotation.
+        """
+        successor, reply, probability, event = EDGE.unpack_from(
+            self._map, self._edges + (node * self.symbol_count + symbol) * EDGE.size)
+        if successor == NO_NODE:
+            raise ValueError(f"Node {node} takes no symbol {symbol}")
+        return successor, EVENTS[event], self.text(reply), None if probability == NO_TEXT else self.text(probability)
+
+
+def load_state_machine(knowledge_base, path=None):
+    """
+    Maps the state machine file (STATE_MACHINE_PATH, by default
+    app/knowledge_base.states) if it was built for `knowledge_base`, else
+    returns None. An empty STATE_MACHINE_PATH turns it off.
+    """
+    path = os.environ.get('STATE_MACHINE_PATH', DEFAULT_PATH) if path is None else path
+    if not path or not os.path.exists(path):
+        return None
+    digest = machine_digest(knowledge_base)
+    try:
+        machine = StateMachine(path)
+    except (OSError, ValueError, struct.error):
+        logger.warning("Could not read the state machine file", exc_info=True, extra={"path": path})
+        return None
+    if digest is None or machine.digest != digest:
+        logger.warning("State machine file was built for another knowledge base; rebuild it with "
+                       "'python -m app.state_machine build'", extra={"path": path})
+        return None
+    return machine
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        sys.exit("usage: python -m app.state_machine build [path]")
+    from app.knowledge_base import build_knowledge_base
+
+    materialized = build_state_machine(build_knowledge_base())
+    write_state_machine(materialized, *sys.argv[2:3])
+    print(f"{len(materialized.states)} states written")
@@ -1,3 +1,4 @@
+import json
 import pytest
 import sys
 import os
@@ -5,7 +6,18 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from fastapi.testclient import TestClient
 from app.main import app
 from app.car_troubleshooting import CarTroubleshootingChatbot
-from app.car_troubleshooting import create_bayesian_network
+from app.car_troubleshooting import create_bayesian_network, CarTroubleshootingSystem, SYMPTOMS, SYMPTOM_FACTS
+from app.decision_graph import compile_rules
+from app.knowledge_base import KnowledgeBase, get_knowledge_base, reload_knowledge_base
+from app.knowledge_file import DEFAULT_PATH, build_engine_class, network_to_spec, to_document
+from app.sessions import CompactSessionStore, SerializedSessionStore, SessionStore
+from app.session_backends import MemoryBackend, RedisBackend, SQLiteBackend
+from app.log_writer import ChatLogWriter
+from app.workers import DiagnosisPool, PoolSaturated
+from app.inference import CachedInference, PgmpyInference, TensorInference
+from app.engine_pool import EnginePool
+from app.metrics import ENGINE_POOL_CHECKOUTS, ENGINE_POOL_DISCARDS
+from pgmpy.inference import VariableElimination
 
 client = TestClient(app)
 
@@ -46,4 +58,691 @@ def test_bayesian_network_structure():
 def test_bayesian_network_cpds():
     model = create_bayesian_network()
     assert model.get_cpds("Battery") is not None 
-    assert model.get_cpds("Ignition") is not None  
\ No newline at end of file
+    assert model.get_cpds("Ignition") is not None  
+def test_chat_sessions_are_isolated():
+    first = client.post("/api/chat", json={"message": "not starting"})
+    session_id = first.headers["X-Session-Id"]
+    other = client.post("/api/chat", json={"message": "brakes"}, headers={"X-Session-Id": "other-user"})
+    assert other.json()["response"] == "Do the brakes stop the car?"
+    follow_up = client.post("/api/chat", json={"message": "no"}, headers={"X-Session-Id": session_id})
+    assert "Do the battery read over 12V?" in follow_up.json()["response"]
+
+def test_session_store_lru_and_ttl_eviction():
+    now = [0.0]
+    store = SessionStore(dict, max_sessions=2, ttl=10, clock=lambda: now[0])
+    store.get_or_create("a")
+    store.get_or_create("b")
+    store.get("a")
+    store.get_or_create("c")  # Evicts "b", the least recently used
+    assert "a" in store and "c" in store and "b" not in store
+    now[0] = 11
+    assert store.get("a") is None
+    assert len(store) == 0
+
+ENTRY_MESSAGES = ["not starting", "car stall", "unusual noise", "tick noise", "streaming", "leaking", "brakes", "electric problems"]
+
+def _replay(engine_mode, messages, knowledge_base=None):
+    chatbot = CarTroubleshootingChatbot(engine_mode=engine_mode, knowledge_base=knowledge_base)
+    return [chatbot.diagnose(message) for message in messages]
+
+def test_graph_engine_matches_experta_on_every_path():
+    # The hand-written rule classes, not the engine generated from the knowledge-base file
+    kb = get_knowledge_base()
+    rule_classes = KnowledgeBase(kb.graph, kb.inference, SYMPTOMS, SYMPTOM_FACTS, engine_class=CarTroubleshootingSystem)
+    pending = [[message] for message in ENTRY_MESSAGES]
+    conversations = 0
+    while pending:
+        messages = pending.pop()
+        replies = _replay("experta", messages, rule_classes)
+        assert _replay("graph", messages) == replies
+        if "Diagnostic:" in replies[-1] or "There are no more questions." in replies[-1]:
+            conversations += 1
+        else:
+            pending.extend(messages + [answer] for answer in ("yes", "no"))
+    assert conversations > 60
+
+def test_decision_graph_compiles_chained_rules():
+    graph = get_knowledge_base().graph
+    assert graph.step("drop_on_shifts", "yes").declares == (("ticks_moving", "no"),)
+    assert graph.expected_facts["Do the Starter cranks?"] == "starter_cranks"
+
+def test_cached_inference_matches_pgmpy_and_invalidates_on_reload():
+    model = create_bayesian_network()
+    inference = CachedInference(model)
+    expected = VariableElimination(model).query(["NoStart"], evidence={"Battery": 1}).values
+    # The NumPy backend sums in a different order than pgmpy, so the last bit may differ
+    assert inference.query("NoStart", {"Battery": 1}) == pytest.approx(tuple(expected), abs=1e-12)
+    assert len(inference) == 1
+    inference.query("NoStart", {"Battery": 1})
+    assert len(inference) == 1
+    # Rejected queries are cached, but every hit raises a fresh exception
+    errors = []
+    for _ in range(2):
+        with pytest.raises(Exception) as info:
+            inference.query("NoStart", {"Unknown": 1})
+        errors.append(info.value)
+    assert errors[0] is not errors[1] and type(errors[0]) is type(errors[1]) and errors[0].args == errors[1].args
+    assert len(inference) == 2
+    inference.load(create_bayesian_network())
+    assert len(inference) == 0
+
+def test_symptom_matcher_keeps_priority_order():
+    def first_phrase(message):
+        for symptom, phrases in SYMPTOMS.items():
+            for phrase in phrases:
+                if phrase in message:
+                    return symptom, phrase
+        return None
+    messages = ["my brakes wont start", "noise in car stall", "electric leak", "strange noise when brake",
+                "ticks and streaming", "random text", "leaking electronic brakes problems"]
+    for message in messages:
+        match = get_knowledge_base().symptom_matcher.match(message)
+        assert ((match.label, match.phrase) if match else None) == first_phrase(message)
+    match = get_knowledge_base().symptom_matcher.match("the car wont start today")
+    assert match.label == "no_start" and match.span == (8, 18)
+
+def test_chatbots_share_one_knowledge_base():
+    first, second = CarTroubleshootingChatbot(), CarTroubleshootingChatbot()
+    assert first.knowledge_base is second.knowledge_base is get_knowledge_base()
+    first.diagnose("brakes")
+    assert second.current_question is None
+
+def test_chat_log_writer_batches_and_rotates(tmp_path):
+    path = tmp_path / "chat.log"
+    writer = ChatLogWriter(path=str(path), batch_size=10, max_bytes=100, backup_count=2)
+    for index in range(30):
+        writer.write(f"2024-01-01 00:00:00 - User: message {index}\n")
+    writer.close()
+    written = [path.with_name(f"chat.log.{index}") for index in (2, 1)] + [path]
+    lines = [line for file in written if file.exists() for line in file.read_text().splitlines()]
+    assert lines[-1].endswith("message 29")
+    assert path.with_name("chat.log.1").exists()
+    assert not path.with_name("chat.log.3").exists()
+
+def test_metrics_endpoint_reports_request_and_stage_latency():
+    client.post("/api/chat", json={"message": "not starting"}, headers={"X-Session-Id": "metrics"})
+    client.post("/api/chat", json={"message": "no"}, headers={"X-Session-Id": "metrics"})
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'chatbot_request_duration_seconds_count{method="POST",path="/api/chat",status="200"}' in body
+    for stage in ("matching", "rules", "inference"):
+        assert f'chatbot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}}' in body
+
+def test_process_pool_reports_stage_timings_to_the_server():
+    import asyncio
+    from app.metrics import STAGE_SECONDS
+    pool = DiagnosisPool(SessionStore(CarTroubleshootingChatbot), workers=1, mode='process')
+
+    def count(stage):
+        series = STAGE_SECONDS._series.get((stage,))
+        return series[-1] if series else 0
+
+    async def scenario():
+        before = count('rules')
+        assert await pool.diagnose("a", "brakes") == "Do the brakes stop the car?"
+        events = [event async for event in pool.diagnose_events("a", "no")]
+        return before, events
+
+    try:
+        before, events = asyncio.run(scenario())
+    finally:
+        pool.shutdown()
+    assert events[0] == ('question', 'Is the pedal to the floor?')
+    assert count('rules') >= before + 2
+
+def test_benchmark_covers_every_diagnostic():
+    from benchmarks.bench_diagnose import conversation_scripts, run_benchmark
+    scripts = conversation_scripts()
+    assert {messages[0] for messages in scripts} == {phrases[0] for phrases in SYMPTOMS.values()}
+    report = run_benchmark(iterations=1)
+    assert report["turns"] == sum(len(messages) for messages in scripts)
+    assert set(report["latency_ms"]) == {"turn", "matching", "rules", "inference"}
+
+def test_diagnosis_pool_sheds_load_when_saturated():
+    import asyncio
+    import threading
+    release = threading.Event()
+
+    class SlowChatbot:
+        def diagnose(self, message):
+            release.wait(5)
+            return message
+
+    pool = DiagnosisPool(SessionStore(SlowChatbot), workers=2, max_pending=1, retry_after=3)
+
+    async def scenario():
+        first = asyncio.ensure_future(pool.diagnose("a", "first"))
+        await asyncio.sleep(0)
+        with pytest.raises(PoolSaturated) as saturated:
+            await pool.diagnose("b", "second")
+        release.set()
+        return await first, saturated.value.retry_after
+
+    assert asyncio.run(scenario()) == ("first", 3)
+
+    # A caller that goes away leaves its turn pending until the lane is done with it
+    release.clear()
+
+    async def cancelled():
+        first = asyncio.ensure_future(pool.diagnose("a", "first"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0.05)
+        with pytest.raises(PoolSaturated):
+            await pool.diagnose("b", "second")
+        release.set()
+        while pool.pending:
+            await asyncio.sleep(0.01)
+        return await pool.diagnose("b", "third")
+
+    assert asyncio.run(cancelled()) == "third"
+
+    # A failing turn still saves the session, which returns what it borrowed
+    saved = []
+
+    class FailingChatbot:
+        def diagnose(self, message):
+            raise ValueError(message)
+
+    class RecordingStore(SessionStore):
+        def save(self, session_id, state):
+            saved.append(session_id)
+
+    failing = DiagnosisPool(RecordingStore(FailingChatbot), workers=1)
+    with pytest.raises(ValueError):
+        asyncio.run(failing.diagnose("a", "boom"))
+    assert saved == ["a"] and failing.pending == 0
+    pool.shutdown()
+    failing.shutdown()
+
+    # A turn the lane refuses does not keep its slot
+    async def refused():
+        with pytest.raises(RuntimeError):
+            await pool.diagnose("a", "late")
+        with pytest.raises(RuntimeError):
+            pool.diagnose_events("a", "late")
+        return pool.pending
+
+    assert asyncio.run(refused()) == 0
+    assert pool.lane_for("same-session") == pool.lane_for("same-session")
+    pool.shutdown()
+
+def test_chat_batch_replays_isolated_conversations(monkeypatch):
+    from app import endpoints
+    from app.batch import BatchReplayer
+    monkeypatch.setattr(endpoints, "batch_replayer", BatchReplayer(workers=0, chunk_size=1))
+    conversations = [["not starting", "no", "no"], ["brakes", "no", "no"], ["random text"]]
+    results = client.post("/api/chat/batch", json={"conversations": conversations}).json()["results"]
+    assert [result["index"] for result in results] == [0, 1, 2]
+    assert results[0]["diagnostic"].startswith("Diagnostic: Attempt to jump-start")
+    assert results[1]["diagnostic"].startswith("Diagnostic: Check for pedal linkage binding")
+    assert results[2]["diagnostic"] is None
+    streamed = client.post("/api/chat/batch", json={"conversations": conversations, "stream": True})
+    lines = [json.loads(line) for line in streamed.text.splitlines()]
+    assert sorted(lines, key=lambda result: result["index"]) == results
+
+def test_knowledge_file_is_in_sync_with_rule_classes():
+    with open(DEFAULT_PATH) as file:
+        document = json.load(file)
+    assert document == to_document(compile_rules(CarTroubleshootingSystem), SYMPTOMS, SYMPTOM_FACTS,
+                                   create_bayesian_network())
+
+def test_engine_built_from_knowledge_file_runs_chained_rules():
+    engine = build_engine_class(get_knowledge_base().graph)()
+    engine.reset()
+    for fact, value in [("clunk_or_singletick", "no"), ("ticks_moving", "yes"), ("ticks_on_neutral", "yes"), ("drop_on_shifts", "yes")]:
+        engine.assert_fact(fact, value)
+    assert engine.get_questions() == ["Only ticks when moving?", "Ticks rolling in neutral?", "Frequency drops on shifts?",
+                                      "Preliminary diagnostic: Try to localize the tick using a hearing tube or long screwdriver. Now respond, do you hear only ticks when cold?"]
+    assert engine.expected_facts["Frequency drops on shifts?"] == "drop_on_shifts"
+
+def test_reload_keeps_conversations_in_progress_on_their_version(tmp_path, monkeypatch):
+    from app import knowledge_base as knowledge_base_module
+    monkeypatch.setattr(knowledge_base_module, "_knowledge_base", get_knowledge_base())
+    with open(DEFAULT_PATH) as file:
+        document = json.load(file)
+    for transition in document["transitions"]:
+        if transition["when"] == ["brakes_stop_car", "no"]:
+            transition["emit"] = ["Diagnostic: Updated brake advice."]
+    document["network"]["cpds"][0]["values"] = [[0.5], [0.5]]
+    path = tmp_path / "knowledge_base.json"
+    path.write_text(json.dumps(document))
+
+    in_progress, idle = CarTroubleshootingChatbot(), CarTroubleshootingChatbot()
+    in_progress.diagnose("brakes")
+    old_version = in_progress.knowledge_base.version
+    from app import endpoints
+    assert client.post("/api/admin/reload").status_code == 403  # Disabled without ADMIN_TOKEN
+    monkeypatch.setattr(endpoints, "ADMIN_TOKEN", "secret")
+    assert client.post("/api/admin/reload", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    response = client.post("/api/admin/reload", headers={"X-Admin-Token": "secret"})
+    assert response.json()["version"] > old_version
+    new = reload_knowledge_base(str(path))
+    assert new.model.get_cpds(document["network"]["cpds"][0]["variable"]).get_values().tolist() == [[0.5], [0.5]]
+
+    assert "Is the pedal to the floor?" in in_progress.diagnose("no")
+    assert in_progress.knowledge_base.version == old_version
+    idle.diagnose("brakes")
+    assert "Updated brake advice" in idle.diagnose("no")
+    assert idle.knowledge_base is new
+
+def test_serialized_sessions_finish_on_their_version_after_a_reload(tmp_path, monkeypatch):
+    from collections import OrderedDict
+    from app import knowledge_base as knowledge_base_module
+    from app.chatbot import RESTARTED_NOTICE
+    monkeypatch.setattr(knowledge_base_module, "_knowledge_base", get_knowledge_base())
+    monkeypatch.setattr(knowledge_base_module, "_superseded", OrderedDict())
+    with open(DEFAULT_PATH) as file:
+        document = json.load(file)
+    for transition in document["transitions"]:
+        if transition["when"] == ["brakes_stop_car", "no"]:
+            transition["emit"] = ["Diagnostic: Updated brake advice."]
+    path = tmp_path / "knowledge_base.json"
+    path.write_text(json.dumps(document))
+
+    store = SerializedSessionStore(CarTroubleshootingChatbot, MemoryBackend())
+    for session_id in ("in_progress", "forgotten"):
+        _, chatbot = store.get_or_create(session_id)
+        chatbot.diagnose("brakes")
+        store.save(session_id, chatbot)
+    old_digest = get_knowledge_base().digest
+    new = reload_knowledge_base(str(path))
+    assert new.digest != old_digest
+
+    _, chatbot = store.get_or_create("in_progress")
+    assert "Is the pedal to the floor?" in chatbot.diagnose("no")
+    store.save("in_progress", chatbot)
+    assert json.loads(store.backend.load("in_progress"))["d"] == old_digest
+    _, chatbot = store.get_or_create("new")
+    chatbot.diagnose("brakes")
+    assert "Updated brake advice" in chatbot.diagnose("no")
+
+    # Once the old version is no longer kept, the conversation starts over and says so
+    knowledge_base_module._superseded.clear()
+    _, chatbot = store.get_or_create("forgotten")
+    assert chatbot.diagnose("no").startswith(RESTARTED_NOTICE + " There are no pending questions.")
+    assert not chatbot.diagnose("no").startswith(RESTARTED_NOTICE)
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.data if key.startswith(match.rstrip("*"))]
+
+def _replay_through_store(store, messages):
+    replies = []
+    for message in messages:
+        _, chatbot = store.get_or_create("session")
+        replies.append(chatbot.diagnose(message))
+        store.save("session", chatbot)
+    store.delete("session")
+    return replies
+
+def test_serialized_sessions_resume_on_any_backend(tmp_path):
+    conversations = [["not starting", "no", "yes", "no"], ["car stall", "yes", "no", "no", "yes"],
+                     ["leaking", "yes", "no"], ["brakes", "no", "no"], ["electric problems", "yes", "no"]]
+    backends = [MemoryBackend(), SQLiteBackend(str(tmp_path / "sessions.db")), RedisBackend(FakeRedis())]
+    for backend in backends:
+        store = SerializedSessionStore(CarTroubleshootingChatbot, backend)
+        for messages in conversations:
+            assert _replay_through_store(store, messages) == _replay("graph", messages)
+        assert len(store) == 0
+
+    kb = get_knowledge_base()
+    rule_classes = KnowledgeBase(kb.graph, kb.inference, SYMPTOMS, SYMPTOM_FACTS, engine_class=CarTroubleshootingSystem)
+    experta_store = SerializedSessionStore(
+        lambda: CarTroubleshootingChatbot(engine_mode="experta", knowledge_base=rule_classes), MemoryBackend())
+    for messages in conversations[:2]:
+        assert _replay_through_store(experta_store, messages) == _replay("experta", messages, rule_classes)
+
+def test_tensor_inference_matches_pgmpy():
+    import itertools
+    model = create_bayesian_network()
+    tensor, pgmpy = TensorInference(model), PgmpyInference(model)
+    # The `network` section of a knowledge-base file gives the same tensors without pgmpy
+    from_spec = TensorInference(network_to_spec(model))
+    variables = sorted(model.nodes())
+    for variable in variables:
+        others = [name for name in variables if name != variable]
+        for evidence_variables in itertools.chain.from_iterable(itertools.combinations(others, k) for k in range(3)):
+            rows = list(itertools.product([0, 1], repeat=len(evidence_variables)))
+            batch = tensor.posteriors(variable, evidence_variables, rows)
+            for row, posterior in zip(rows, batch):
+                expected = pgmpy.posterior(variable, dict(zip(evidence_variables, row)))
+                assert tensor.posterior(variable, dict(zip(evidence_variables, row))) == pytest.approx(expected, abs=1e-12)
+                assert posterior.tolist() == pytest.approx(list(expected), abs=1e-12)
+                assert from_spec.posterior(variable, dict(zip(evidence_variables, row))) == pytest.approx(expected, abs=1e-12)
+    # The chatbot's brake and electrical queries are rejected by both backends
+    for variable, evidence in [("BrakeFailure", {"BrakeFailure": 0}), ("ElectricalFailure", {"Is there an electrical failure?": 1}),
+                               ("NoStart", {"Battery": 2})]:
+        for backend in (tensor, pgmpy):
+            with pytest.raises((ValueError, KeyError)):
+                backend.posterior(variable, evidence)
+
+def test_health_endpoints_and_lazy_imports():
+    import subprocess
+    from concurrent.futures import Future
+    assert client.get("/api/health/live").json() == {"status": "live"}
+    warmup = app.state.warmup = Future()
+    try:
+        assert client.get("/api/health/ready").status_code == 503
+        warmup.set_result(get_knowledge_base())
+        ready = client.get("/api/health/ready")
+    finally:
+        app.state.warmup = None
+    assert ready.status_code == 200
+    assert ready.json()["kb_version"] == get_knowledge_base().version
+    # Serving 'graph' conversations must not need the rule engine or pgmpy
+    probe = ("import sys; from app.chatbot import CarTroubleshootingChatbot; import app.main;"
+             "CarTroubleshootingChatbot(engine_mode='graph').diagnose('not starting');"
+             "print(sorted({'experta', 'pgmpy'} & set(sys.modules)))")
+    output = subprocess.run([sys.executable, "-c", probe], cwd=os.path.join(os.path.dirname(__file__), '..'),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
+
+def _sse_events(body):
+    events = []
+    for frame in body.strip().split("\n\n"):
+        event, data = frame.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+def test_chat_stream_sends_reply_before_probability():
+    first = client.post("/api/chat/stream", json={"message": "not starting"})
+    assert first.headers["content-type"].startswith("text/event-stream")
+    session = {"X-Session-Id": first.headers["X-Session-Id"]}
+    assert _sse_events(first.text) == [("question", {"text": "Do the Starter spins?"}), ("done", {})]
+    client.post("/api/chat/stream", json={"message": "no"}, headers=session)
+    events = _sse_events(client.post("/api/chat/stream", json={"message": "no"}, headers=session).text)
+    assert [event for event, _ in events] == ["diagnostic", "probability", "done"]
+    expected = _replay("graph", ["not starting", "no", "no"])[-1]
+    assert expected == f"{events[1][1]['text']} {events[0][1]['text']}"
+
+def test_websocket_chat_binds_a_session_to_the_connection(monkeypatch):
+    import time
+    from starlette.websockets import WebSocketDisconnect
+    from app import endpoints
+    with client.websocket_connect("/api/ws/chat") as websocket:
+        session_id = websocket.receive_json()["session_id"]
+        replies = []
+        for message in ["not starting", "no", "no"]:
+            websocket.send_json({"type": "message", "message": message})
+            events = []
+            while not events or events[-1]["type"] != "done":
+                events.append(websocket.receive_json())
+            replies.append(events)
+        assert replies[0] == [{"type": "question", "text": "Do the Starter spins?"}, {"type": "done"}]
+        assert [event["type"] for event in replies[2]] == ["diagnostic", "probability", "done"]
+        websocket.send_json({"type": "ping"})
+        assert websocket.receive_json() == {"type": "pong"}
+        assert session_id in endpoints.sessions
+    deadline = time.monotonic() + 5
+    while session_id in endpoints.sessions and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert session_id not in endpoints.sessions
+
+    # A turn rejected because the pool is full also ends with "done"
+    monkeypatch.setattr(endpoints.diagnosis_pool, "max_pending", 0)
+    with client.websocket_connect("/api/ws/chat") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"type": "message", "message": "brakes"})
+        error = websocket.receive_json()
+        assert error["type"] == "error" and error["retry_after"] == endpoints.diagnosis_pool.retry_after
+        assert websocket.receive_json() == {"type": "done"}
+    monkeypatch.undo()
+
+    monkeypatch.setattr(endpoints, "WS_HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(endpoints, "WS_IDLE_TIMEOUT", 0.2)
+    with client.websocket_connect("/api/ws/chat") as websocket:
+        websocket.receive_json()
+        assert websocket.receive_json() == {"type": "ping"}
+        with pytest.raises(WebSocketDisconnect):
+            while True:
+                websocket.receive_json()
+
+def test_adaptive_mode_reaches_the_same_diagnostics():
+    from app.adaptive import build_policy, enumerate_leaves
+    kb = get_knowledge_base()
+    entry_messages = {SYMPTOM_FACTS[label]: phrases[0] for label, phrases in SYMPTOMS.items()}
+    for entry, message in entry_messages.items():
+        for leaf in enumerate_leaves(kb.graph, entry):
+            chatbot = CarTroubleshootingChatbot(engine_mode="adaptive")
+            reply, turns = chatbot.diagnose(message), 0
+            while "Diagnostic:" not in reply and "There are no more questions." not in reply:
+                reply = chatbot.diagnose(leaf.answers.get(kb.graph.expected_facts[chatbot.current_question], "yes"))
+                turns += 1
+            assert leaf.message in reply
+            assert turns <= len(leaf.answers)
+    # An answer other than yes/no leaves the question open, as on the other engines
+    replies = {}
+    for mode in ("graph", "experta", "adaptive"):
+        chatbot = CarTroubleshootingChatbot(engine_mode=mode)
+        replies[mode] = [chatbot.diagnose(message) for message in ("brakes", "yeah", "yes", "no")]
+    assert replies["adaptive"] == replies["graph"] == replies["experta"]
+    assert "Do the wheels drag too much?" in replies["adaptive"][-1]
+    # Concluding the likeliest diagnostic early trades a little accuracy for fewer questions
+    assert sum(len(table) for table in build_policy(kb, confidence=0.8).tables.values()) < \
+        sum(len(table) for table in kb.policy.tables.values())
+
+def test_opener_cache_serves_repeated_openers_and_keeps_the_session():
+    from app.metrics import OPENER_CACHE_LOOKUPS
+    from app.opener_cache import opener_cache
+    opener_cache.clear()
+    hits = OPENER_CACHE_LOOKUPS.value("hit")
+    first = CarTroubleshootingChatbot()
+    assert first.diagnose("Car won't start!") == "Do the Starter spins?"
+    second = CarTroubleshootingChatbot()
+    second.evidence = {"Battery": 1}
+    assert second.diagnose("car wont start") == "Do the Starter spins?"
+    assert OPENER_CACHE_LOOKUPS.value("hit") == hits + 1
+    assert second.evidence == {}
+    assert second.diagnose("no") == first.diagnose("no") == " Do the battery read over 12V?"
+    assert "chatbot_opener_cache_lookups_total" in client.get("/api/metrics").text
+
+def test_fuzzy_symptom_matching():
+    from app.matching import FuzzyPhraseMatcher, edit_distance
+    assert edit_distance("brake", "braek") == 1
+    assert edit_distance("start", "strt") == 1
+    matcher = FuzzyPhraseMatcher(SYMPTOMS, threshold=0.8)
+    match = matcher.match("my car wont strt")
+    assert (match.label, match.phrase, match.span) == ("no_start", "wont start", (7, 16))
+    assert match.confidence == pytest.approx(0.9)
+    assert matcher.match("braks").label == "brakes_problem"
+    # Short words and unrelated messages are not guessed at
+    assert matcher.match("lead") is None
+    assert matcher.match("hello there") is None
+    # Only the first words of long messages are corrected, and the memo keeps the most recently used ones
+    small = FuzzyPhraseMatcher(SYMPTOMS, cache_size=2, max_tokens=3)
+    assert small.match("car wont strt") is not None
+    assert small.match("my old car wont strt") is None
+    small.corrections("strt")
+    small.corrections("braks")
+    small.corrections("strt")
+    small.corrections("noize")
+    assert list(small._corrections) == ["strt", "noize"]
+
+    chatbot = CarTroubleshootingChatbot()
+    assert chatbot.diagnose("car wont strt") == "Do the Starter spins?"
+    # While a question is pending, the message is its answer
+    assert chatbot.diagnose("no") == " Do the battery read over 12V?"
+    assert CarTroubleshootingChatbot().diagnose("strange noize") == CarTroubleshootingChatbot().diagnose("strange noise")
+
+def test_session_state_uses_registry_ids():
+    chatbot = CarTroubleshootingChatbot(engine_mode="graph")
+    chatbot.diagnose("car wont start")
+    chatbot.diagnose("no")
+    state = chatbot.dump_state()
+    registry = get_knowledge_base().registry
+    assert state["k"] == registry.fingerprint
+    assert registry.decode_question(state["q"]) == chatbot.current_question == "Do the battery read over 12V?"
+    assert all(type(fact) is int for fact in state["f"])
+    assert chatbot.evidence == {"Do the Starter spins?": 0, "Battery": 0}
+
+    restored = CarTroubleshootingChatbot(engine_mode="graph")
+    restored.load_state(json.loads(json.dumps(state)))
+    assert restored.dump_state() == state
+    # States saved with texts are still read
+    legacy = CarTroubleshootingChatbot(engine_mode="graph")
+    legacy.load_state({"q": chatbot.current_question, "e": chatbot.evidence, "p": [],
+                       "f": chatbot.engine.known_facts()})
+    assert legacy.dump_state() == state
+    assert legacy.diagnose("no") == restored.diagnose("no") == chatbot.diagnose("no")
+    # Ids from another knowledge base start the conversation over
+    other = CarTroubleshootingChatbot(engine_mode="graph")
+    other.load_state(dict(state, k="00000000"))
+    assert other.current_question is None and other.dump_state()["f"] == []
+
+def test_compact_sessions_resume_and_respect_the_memory_cap(monkeypatch):
+    conversations = [["not starting", "no", "yes", "no"], ["car stall", "yes", "no", "no", "yes"],
+                     ["tick noise", "maybe", "no"], ["brakes", "no", "no"], ["electric problems", "yes", "no"]]
+    for mode in ("graph", "experta", "adaptive"):
+        store = CompactSessionStore(lambda: CarTroubleshootingChatbot(engine_mode=mode))
+        for messages in conversations:
+            assert _replay_through_store(store, messages) == _replay(mode, messages)
+        assert len(store) == 0 and store.bytes == 0
+
+    now = [0.0]
+    store = CompactSessionStore(CarTroubleshootingChatbot, ttl=10, clock=lambda: now[0])
+    for session_id in ("a", "b"):
+        _, chatbot = store.get_or_create(session_id)
+        chatbot.diagnose("not starting")
+        store.save(session_id, chatbot)
+    size = store.bytes // 2
+    assert store.stats()["sessions"] == 2 and size < 1024
+    store.max_bytes = size * 2
+    store.get("a")
+    _, chatbot = store.get_or_create("c")
+    store.save("c", chatbot)  # Over the cap: evicts "b", the least recently used
+    assert "a" in store and "c" in store and "b" not in store
+    assert store.bytes <= store.max_bytes
+    now[0] = 11
+    assert store.stats()["sessions"] == 0 and store.bytes == 0
+
+    from app import endpoints
+    monkeypatch.setattr(endpoints, "ADMIN_TOKEN", "secret")
+    stats = client.get("/api/admin/sessions", headers={"X-Admin-Token": "secret"}).json()
+    assert stats["store"] == "compact" and stats["sessions"] >= 1 and stats["bytes"] > 0
+
+def test_engine_pool_hands_out_reset_engines():
+    pool = EnginePool(get_knowledge_base().engine_class, size=1)
+    pool.fill()
+    built, reused, full = (ENGINE_POOL_CHECKOUTS.value("built"), ENGINE_POOL_CHECKOUTS.value("reused"),
+                           ENGINE_POOL_DISCARDS.value("full"))
+    first, second = pool.checkout(), pool.checkout()
+    assert (pool.idle, pool.in_use) == (0, 2)
+    first.assert_fact("starter_cranks", "no")
+    assert first.get_questions() and first.expected_facts
+    pool.checkin(first)
+    pool.checkin(second)  # Over the size: dropped
+    assert (pool.idle, pool.in_use) == (1, 0)
+    assert pool.checkout() is first
+    assert first.known_facts() == [] and first.get_questions() == [] and first.expected_facts == {}
+    assert ENGINE_POOL_CHECKOUTS.value("built") == built + 1 and ENGINE_POOL_CHECKOUTS.value("reused") == reused + 2
+    assert ENGINE_POOL_DISCARDS.value("full") == full + 1
+
+    # Experta conversations give their engine back when the session is saved
+    knowledge_base = get_knowledge_base()
+    store = CompactSessionStore(lambda: CarTroubleshootingChatbot(engine_mode="experta", knowledge_base=knowledge_base))
+    _, chatbot = store.get_or_create("pooled")
+    engine = chatbot.engine
+    chatbot.diagnose("not starting")
+    store.save("pooled", chatbot)
+    assert chatbot.engine is None and knowledge_base.engine_pool.checkout() is engine
+    assert 'chatbot_engine_pool_engines{state="idle"}' in client.get("/api/metrics").text
+
+def test_prefork_workers_share_the_preloaded_app(tmp_path):
+    import http.client
+    import signal
+    import socket
+    import subprocess
+    import time
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    # Process lanes and SQLite connections must be each worker's own, not the master's
+    env = dict(os.environ, DIAGNOSIS_POOL="process", DIAGNOSIS_WORKERS="1",
+               SESSION_BACKEND="sqlite", SESSION_SQLITE_PATH=str(tmp_path / "sessions.db"))
+    master = subprocess.Popen([sys.executable, "-m", "app.prefork", "--workers", "2", "--port", str(port)],
+                              cwd=os.path.join(os.path.dirname(__file__), '..'), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    workers = {}  # pid -> a keep-alive connection served by that worker
+    try:
+        deadline = time.monotonic() + 60
+        while len(workers) < 2 and time.monotonic() < deadline:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            try:
+                connection.request("GET", "/api/health/ready")
+                response = connection.getresponse()
+                body = json.loads(response.read())
+            except OSError:
+                connection.close()
+                time.sleep(0.05)
+                continue
+            if response.status == 200 and body["pid"] not in workers:
+                workers[body["pid"]] = connection
+            else:
+                connection.close()
+                time.sleep(0.05)
+        # Both workers were forked from the master and answer on its socket
+        assert len(workers) == 2
+        for pid in workers:
+            with open(f"/proc/{pid}/stat") as file:
+                assert int(file.read().rsplit(")", 1)[1].split()[1]) == master.pid
+
+        def chat(connection, session_id, message):
+            connection.request("POST", "/api/chat", json.dumps({"message": message}),
+                               {"Content-Type": "application/json", "X-Session-Id": session_id})
+            response = connection.getresponse()
+            assert response.status == 200
+            return json.loads(response.read())["response"]
+
+        # Every worker completes turns, and a conversation started on one goes on on the other
+        first, second = workers.values()
+        assert chat(first, "a", "car wont start") == "Do the Starter spins?"
+        assert chat(second, "b", "car wont start") == "Do the Starter spins?"
+        assert "Do the battery read over 12V?" in chat(second, "a", "no")
+        assert "Do the battery read over 12V?" in chat(first, "b", "no")
+    finally:
+        for connection in workers.values():
+            connection.close()
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(timeout=30) == 0
+
+def test_state_machine_serves_the_same_conversations(tmp_path):
+    from app.knowledge_base import build_knowledge_base
+    from app.state_machine import build_state_machine, load_state_machine, write_state_machine
+    knowledge_base = build_knowledge_base()
+    path = str(tmp_path / "knowledge_base.states")
+    write_state_machine(build_state_machine(knowledge_base), path)
+    knowledge_base._state_machine = load_state_machine(knowledge_base, path)
+    assert knowledge_base.state_machine is not None
+    conversations = [["not starting", "no", "yes", "no"], ["car stall", "yes", "maybe", "no", "yes"],
+                     ["brakes", "yes", "electric problems", "no", "no"], ["car wont strt", "nope", "hello", "no"]]
+    for messages in conversations:
+        on_machine = CarTroubleshootingChatbot("graph", knowledge_base)
+        on_rules = CarTroubleshootingChatbot("graph", knowledge_base)
+        on_rules.state_machine, on_rules._node = None, None
+        saved = None
+        for message in messages:
+            resumed = CarTroubleshootingChatbot("graph", knowledge_base)
+            if saved is not None:
+                resumed.load_state(json.loads(saved))
+            assert on_machine.diagnose(message) == on_rules.diagnose(message) == resumed.diagnose(message)
+            assert on_machine.evidence == on_rules.evidence
+            saved = json.dumps(resumed.dump_state())
+        assert on_machine._node is not None and on_machine.compact().nbytes() < 100
+    # A file built for another knowledge base is not used
+    other = build_knowledge_base()
+    other.digest = "0" * 40
+    assert load_state_machine(other, path) is None
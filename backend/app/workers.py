@@ -0,0 +1,251 @@
+import asyncio
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.metrics import collected_stages, record_stages
+from app.sessions import create_session_store
+
+
+POOL_MODES = ('thread', 'process')
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when every worker is busy and the pending queue is full.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Diagnosis pool saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+_worker_sessions = None
+
+
+def _worker_session_store():
+    # Each worker process keeps its own store, so the sessions pinned to it
+    global _worker_sessions
+    if _worker_sessions is None:
+        from app.chatbot import CarTroubleshootingChatbot
+        _worker_sessions = create_session_store(CarTroubleshootingChatbot)
+    return _worker_sessions
+
+
+# Turns in a worker process return their stage timings with the result, since metrics
+# recorded in the worker would never reach /metrics of the server process
+
+def _diagnose_in_worker(session_id, message):
+    sessions = _worker_session_store()
+    _, chatbot = sessions.get_or_create(session_id)
+    try:
+        with collected_stages() as stages:
+            return chatbot.diagnose(message), stages
+    finally:
+        sessions.save(session_id, chatbot)
+
+
+def _diagnose_events_in_worker(session_id, message):
+    # Events cannot be handed back one at a time across processes, so the whole turn is returned
+    sessions = _worker_session_store()
+    _, chatbot = sessions.get_or_create(session_id)
+    try:
+        with collected_stages() as stages:
+            return list(chatbot.diagnose_events(message)), stages
+    finally:
+        sessions.save(session_id, chatbot)
+
+
+def _warm_up_in_worker():
+    from app.chatbot import warm_up
+    return warm_up().version
+
+
+def _session_stats_in_worker():
+    return _worker_session_store().stats()
+
+
+def _end_session_in_worker(session_id):
+    _worker_session_store().delete(session_id)
+
+
+class DiagnosisPool:
+    """
+    Runs diagnosis turns off the event loop.
+
+    Each worker is a single-threaded executor ("lane") and every session is
+    pinned to one lane by a hash of its id, so turns of one conversation run
+    in order and never concurrently. In 'thread' mode the conversation state
+    lives in `sessions`; in 'process' mode each worker process opens its own
+    session store (private to it with the memory backend), which gives true
+    parallelism for the CPU-bound rule and inference work. At most `max_pending` turns may be queued or running;
+    beyond that `diagnose()` raises PoolSaturated. The lanes are only started
+    by the process that submits to them, so a pool built before a fork (see
+    app.prefork) gets new lanes in each forked process.
+    """
+
+    def __init__(self, sessions, workers=4, max_pending=256, mode='thread', retry_after=1):
+        if mode not in POOL_MODES:
+            raise ValueError(f"Unknown pool mode {mode!r}, expected one of {POOL_MODES}")
+        self.sessions = sessions
+        self.mode = mode
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.workers = workers
+        self.pending = 0
+        self._executors = None
+        self._pid = None
+
+    @property
+    def _lanes(self):
+        # Only touched from the event loop thread, like `pending`. A process lane's call and result
+        # queues must not be shared by forked processes, so each process builds its own lanes
+        if self._pid != os.getpid():
+            if self.mode == 'process':
+                self._executors = [ProcessPoolExecutor(max_workers=1) for _ in range(self.workers)]
+            else:
+                self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"diagnosis-{index}")
+                                   for index in range(self.workers)]
+            self._pid = os.getpid()
+        return self._executors
+
+    def lane_for(self, session_id):
+        return zlib.crc32(session_id.encode()) % self.workers
+
+    def _diagnose_in_thread(self, session_id, message):
+        _, chatbot = self.sessions.get_or_create(session_id)
+        try:
+            return chatbot.diagnose(message)
+        finally:
+            # Saving also returns what the chatbot borrowed for the turn, e.g. its pooled engine
+            self.sessions.save(session_id, chatbot)
+
+    def _admit(self):
+        # Only touched from the event loop thread, so the counter needs no lock
+        if self.pending >= self.max_pending:
+            raise PoolSaturated(self.retry_after)
+        self.pending += 1
+
+    async def diagnose(self, session_id, message):
+        self._admit()
+        loop = asyncio.get_running_loop()
+        lane = self._lanes[self.lane_for(session_id)]
+        try:
+            if self.mode == 'process':
+                future = lane.submit(_diagnose_in_worker, session_id, message)
+            else:
+                future = lane.submit(self._diagnose_in_thread, session_id, message)
+        except BaseException:
+            self.pending -= 1
+            raise
+        # A caller that goes away does not stop a turn already queued or running, so the turn
+        # stays pending until the lane is done with it; the callback runs on the lane, hence the hop
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        if self.mode != 'process':
+            return await asyncio.wrap_future(future)
+        response, stages = await asyncio.wrap_future(future)
+        record_stages(stages)
+        return response
+
+    def _release(self):
+        self.pending -= 1
+
+    def _diagnose_events_in_thread(self, session_id, message, emit):
+        _, chatbot = self.sessions.get_or_create(session_id)
+        try:
+            for event in chatbot.diagnose_events(message):
+                emit(event)
+        finally:
+            self.sessions.save(session_id, chatbot)
+
+    async def warm_up(self):
+        """
+        Warms up the knowledge base once in 'thread' mode, where it is
+        shared, or in every worker process in 'process' mode.
+        """
+        lanes = self._lanes if self.mode == 'process' else self._lanes[:1]
+        await asyncio.gather(*(asyncio.wrap_future(lane.submit(_warm_up_in_worker)) for lane in lanes))
+
+    def diagnose_events(self, session_id, message):
+        """
+        Starts a turn and returns an async iterator over its `(event, text)`
+        pairs as the chatbot produces them. PoolSaturated is raised right away,
+        before any event. In 'process' mode the events arrive together when
+        the turn ends. The turn runs to completion even if the iterator is
+        abandoned, so the session is never left half-updated.
+        """
+        self._admit()
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        lane = self._lanes[self.lane_for(session_id)]
+        try:
+            if self.mode == 'process':
+                future = asyncio.wrap_future(lane.submit(_diagnose_events_in_worker, session_id, message))
+            else:
+                emit = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+                future = asyncio.wrap_future(lane.submit(self._diagnose_events_in_thread, session_id, message, emit))
+        except BaseException:
+            self.pending -= 1
+            raise
+
+        def finished(future):
+            self.pending -= 1
+            if self.mode == 'process' and not future.cancelled() and future.exception() is None:
+                turn_events, stages = future.result()
+                record_stages(stages)
+                for event in turn_events:
+                    events.put_nowait(event)
+            events.put_nowait(None)
+
+        # Events emitted from the lane thread are queued before the future completes
+        future.add_done_callback(finished)
+        return self._iterate_events(events, future)
+
+    @staticmethod
+    async def _iterate_events(events, future):
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+        future.result()
+
+    def end_session(self, session_id):
+        """
+        Drops the state of a session. It runs on the session's lane, after any
+        turn of it still queued there, so that turn cannot store it again.
+        """
+        lane = self._lanes[self.lane_for(session_id)]
+        try:
+            if self.mode == 'process':
+                lane.submit(_end_session_in_worker, session_id)
+            else:
+                lane.submit(self.sessions.delete, session_id)
+        except RuntimeError:
+            # The pool is already shut down, and its sessions with it
+            pass
+
+    async def session_stats(self):
+        """
+        Returns the stats of the session store. In 'process' mode each worker
+        has its own store, and their counts and bytes are summed unless the
+        backend is shared.
+        """
+        if self.mode != 'process':
+            # A shared backend counts its sessions with a query (a keyspace scan on Redis), so not on the loop
+            return await asyncio.get_running_loop().run_in_executor(None, self.sessions.stats)
+        stats = await asyncio.gather(*(asyncio.wrap_future(lane.submit(_session_stats_in_worker))
+                                       for lane in self._lanes))
+        if stats[0].get("shared"):
+            return stats[0]
+        total = dict(stats[0], workers=len(stats), sessions=sum(worker["sessions"] for worker in stats))
+        if all(worker["bytes"] is not None for worker in stats):
+            total["bytes"] = sum(worker["bytes"] for worker in stats)
+        return total
+
+    def shutdown(self, wait=True):
+        # Lanes inherited through a fork belong to the parent
+        if self._pid != os.getpid():
+            return
+        for lane in self._executors:
+            lane.shutdown(wait=wait)
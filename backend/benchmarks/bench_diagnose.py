@@ -0,0 +1,164 @@
+"""
+Throughput and per-turn latency benchmark for CarTroubleshootingChatbot.diagnose.
+
+Drives every scripted conversation (each entry symptom followed by every yes/no
+path down to a diagnostic) either directly through the chatbot or over HTTP
+through /api/chat, and reports turns/sec plus p50/p95/p99 latency per stage.
+
+    python benchmarks/bench_diagnose.py --engine graph --iterations 20 --save baseline.json
+    python benchmarks/bench_diagnose.py --engine graph --baseline baseline.json
+    python benchmarks/bench_diagnose.py --http
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from app.chatbot import CarTroubleshootingChatbot, SYMPTOMS
+from app.metrics import add_stage_listener, remove_stage_listener
+
+PERCENTILES = (50, 95, 99)
+
+
+def conversation_scripts():
+    """
+    Returns the message lists of every conversation from an entry symptom to a leaf.
+    """
+    scripts = []
+    pending = [[phrases[0]] for phrases in SYMPTOMS.values()]
+    while pending:
+        messages = pending.pop()
+        chatbot = CarTroubleshootingChatbot(engine_mode='graph')
+        for message in messages:
+            reply = chatbot.diagnose(message)
+        if "Diagnostic:" in reply or "There are no more questions." in reply:
+            scripts.append(messages)
+        else:
+            pending.extend(messages + [answer] for answer in ("yes", "no"))
+    return sorted(scripts)
+
+
+def percentile(samples, pct):
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def run_direct(scripts, iterations, engine_mode):
+    turn_samples = []
+    for _ in range(iterations):
+        for messages in scripts:
+            chatbot = CarTroubleshootingChatbot(engine_mode=engine_mode)
+            try:
+                for message in messages:
+                    start = time.perf_counter()
+                    chatbot.diagnose(message)
+                    turn_samples.append(time.perf_counter() - start)
+            finally:
+                # Hands a pooled experta engine back, as saving the session does in the server
+                chatbot.release()
+    return turn_samples
+
+
+def run_http(scripts, iterations):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    turn_samples = []
+    with TestClient(app) as client:
+        for iteration in range(iterations):
+            for index, messages in enumerate(scripts):
+                headers = {"X-Session-Id": f"bench-{iteration}-{index}"}
+                for message in messages:
+                    start = time.perf_counter()
+                    response = client.post("/api/chat", json={"message": message}, headers=headers)
+                    turn_samples.append(time.perf_counter() - start)
+                    response.raise_for_status()
+    return turn_samples
+
+
+def run_benchmark(iterations=10, engine_mode='graph', http=False):
+    scripts = conversation_scripts()
+    stage_samples = defaultdict(list)
+
+    def record(stage, seconds):
+        stage_samples[stage].append(seconds)
+
+    add_stage_listener(record)
+    try:
+        start = time.perf_counter()
+        if http:
+            turn_samples = run_http(scripts, iterations)
+        else:
+            turn_samples = run_direct(scripts, iterations, engine_mode)
+        elapsed = time.perf_counter() - start
+    finally:
+        remove_stage_listener(record)
+
+    latency_ms = {}
+    for stage, samples in [('turn', turn_samples)] + sorted(stage_samples.items()):
+        latency_ms[stage] = {f"p{pct}": percentile(samples, pct) * 1000 for pct in PERCENTILES}
+    return {
+        "mode": "http" if http else "direct",
+        "engine": engine_mode,
+        "conversations": len(scripts) * iterations,
+        "turns": len(turn_samples),
+        "turns_per_sec": len(turn_samples) / elapsed,
+        "latency_ms": latency_ms,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Prints the change against `baseline` and returns the list of regressions.
+    """
+    regressions = []
+    ratio = report["turns_per_sec"] / baseline["turns_per_sec"]
+    print(f"turns/sec: {report['turns_per_sec']:.1f} vs {baseline['turns_per_sec']:.1f} ({ratio:.2f}x)")
+    if ratio < 1 - tolerance:
+        regressions.append("turns_per_sec")
+    for stage, values in report["latency_ms"].items():
+        previous = baseline["latency_ms"].get(stage)
+        if previous is None:
+            continue
+        for name, value in values.items():
+            change = value / previous[name] if previous[name] else 1.0
+            print(f"{stage:>10} {name}: {value:.3f} ms vs {previous[name]:.3f} ms ({change:.2f}x)")
+            if name == "p95" and change > 1 + tolerance:
+                regressions.append(f"{stage} {name}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10, help="passes over every scripted conversation")
+    parser.add_argument("--engine", choices=("graph", "experta", "adaptive"), default="graph")
+    parser.add_argument("--http", action="store_true", help="go through /api/chat with TestClient")
+    parser.add_argument("--save", metavar="PATH", help="write the report as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a report saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    if args.http:
+        os.environ["CHATBOT_ENGINE"] = args.engine
+    report = run_benchmark(args.iterations, args.engine, args.http)
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Cold-start benchmark for the backend.
+
+Each run starts a fresh interpreter and measures how long `import app.main`
+takes, how long the knowledge-base warm-up takes after it (time to ready) and
+the latency of the first conversation turn. It also records which heavy
+libraries were imported by then, to catch an eager import of experta or pgmpy
+creeping back into the import path.
+
+    python benchmarks/bench_startup.py --runs 5 --save startup.json
+    python benchmarks/bench_startup.py --engine experta --baseline startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("experta", "pgmpy", "torch", "pandas", "networkx")
+STAGES = ("import_s", "ready_s", "first_turn_s")
+
+# Runs in the child interpreter and prints one JSON line
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+heavy_at_import = [name for name in {heavy!r} if name in sys.modules]
+from app.chatbot import CarTroubleshootingChatbot, warm_up
+warm_up()
+ready = time.perf_counter()
+CarTroubleshootingChatbot().diagnose("my car won't start")
+first_turn = time.perf_counter()
+print(json.dumps({{"import_s": imported - start, "ready_s": ready - start, "first_turn_s": first_turn - ready,
+                   "heavy_at_import": heavy_at_import,
+                   "heavy_at_ready": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def run_once(engine_mode):
+    env = dict(os.environ, CHATBOT_ENGINE=engine_mode)
+    output = subprocess.run([sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)], cwd=BACKEND, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(runs=5, engine_mode="graph"):
+    samples = [run_once(engine_mode) for _ in range(runs)]
+    return {
+        "engine": engine_mode,
+        "runs": runs,
+        "seconds": {stage: {"median": statistics.median(sample[stage] for sample in samples),
+                            "min": min(sample[stage] for sample in samples)}
+                    for stage in STAGES},
+        "heavy_at_import": samples[-1]["heavy_at_import"],
+        "heavy_at_ready": samples[-1]["heavy_at_ready"],
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Prints the change against `baseline` and returns the list of regressions.
+    """
+    regressions = []
+    for stage in STAGES:
+        value, previous = report["seconds"][stage]["median"], baseline["seconds"][stage]["median"]
+        change = value / previous if previous else 1.0
+        print(f"{stage:>12}: {value:.3f} s vs {previous:.3f} s ({change:.2f}x)")
+        if change > 1 + tolerance:
+            regressions.append(stage)
+    for name in report["heavy_at_import"]:
+        if name not in baseline["heavy_at_import"]:
+            print(f"{name} is now imported by app.main")
+            regressions.append(f"import of {name}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument("--engine", choices=("graph", "experta", "adaptive"), default="graph")
+    parser.add_argument("--save", metavar="PATH", help="write the report as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a report saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.runs, args.engine)
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
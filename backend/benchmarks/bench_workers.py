@@ -0,0 +1,151 @@
+"""
+Multi-worker server benchmark: memory per worker and time to ready.
+
+Starts the server with N workers, once as `uvicorn app.main:app --workers N`
+(every worker a fresh interpreter) and once with the preforking launcher
+`python -m app.prefork --workers N` (workers forked from a warmed-up
+master), and reports for each:
+
+- ready_s: from launch until every worker has answered /api/health/ready
+  with 200 (workers are told apart by the pid in the reply);
+- per worker: RSS, PSS (pages shared with other processes are split between
+  them) and private memory, from /proc/<pid>/smaps_rollup;
+- total_pss_mb: PSS of the whole process tree, i.e. the memory the server
+  really costs.
+
+Linux only.
+
+    python benchmarks/bench_workers.py --workers 4 --runs 3
+    python benchmarks/bench_workers.py --engine experta --save workers.json
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAUNCHERS = {
+    "uvicorn": [sys.executable, "-m", "uvicorn", "app.main:app", "--workers", "{workers}", "--port", "{port}"],
+    "prefork": [sys.executable, "-m", "app.prefork", "--workers", "{workers}", "--port", "{port}"],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def ready_pid(port):
+    # Returns the pid of the worker that answered, or None while it is not ready
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health/ready", timeout=1) as response:
+            return json.load(response).get("pid")
+    except (OSError, ValueError):
+        return None
+
+
+def wait_until_ready(port, workers, timeout):
+    # Connections land on whichever worker accepts first, so poll in parallel until every pid was seen ready
+    ready = set()
+    deadline = time.monotonic() + timeout
+    with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+        while len(ready) < workers:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"only {len(ready)} of {workers} workers ready after {timeout}s")
+            ready.update(pid for pid in executor.map(ready_pid, [port] * workers * 2) if pid is not None)
+            time.sleep(0.01)
+    return ready
+
+
+def memory(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {"rss_mb": fields["Rss"], "pss_mb": fields["Pss"],
+            "private_mb": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def process_tree(root):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as file:
+                    parent = int(file.read().rsplit(")", 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [root]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, ()))
+    return tree
+
+
+def run_once(launcher, workers, engine_mode, timeout):
+    port = free_port()
+    command = [part.format(workers=workers, port=port) for part in LAUNCHERS[launcher]]
+    env = dict(os.environ, CHATBOT_ENGINE=engine_mode)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        pids = wait_until_ready(port, workers, timeout)
+        ready_s = time.perf_counter() - start
+        # Let the warm-up garbage settle before reading memory
+        time.sleep(1)
+        per_worker = [memory(pid) for pid in sorted(pids)]
+        total_pss = sum(memory(pid)["pss_mb"] for pid in process_tree(process.pid))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return {"ready_s": ready_s, "total_pss_mb": total_pss,
+            **{key: statistics.median(worker[key] for worker in per_worker) for key in per_worker[0]}}
+
+
+def run_benchmark(workers=4, runs=3, engine_mode="graph", launchers=tuple(LAUNCHERS), timeout=120):
+    report = {"workers": workers, "engine": engine_mode, "runs": runs, "launchers": {}}
+    for launcher in launchers:
+        samples = [run_once(launcher, workers, engine_mode, timeout) for _ in range(runs)]
+        report["launchers"][launcher] = {key: statistics.median(sample[key] for sample in samples)
+                                         for key in samples[0]}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3, help="launches per launcher (medians are reported)")
+    parser.add_argument("--engine", choices=("graph", "experta", "adaptive"), default="graph")
+    parser.add_argument("--launcher", choices=tuple(LAUNCHERS), action="append",
+                        help="launcher to measure (repeatable, default both)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the workers to be ready")
+    parser.add_argument("--save", metavar="PATH", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.workers, args.runs, args.engine, args.launcher or tuple(LAUNCHERS), args.timeout)
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,12 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import "./App.css";
 
 function App() {
   const [messages, setMessages] = useState([]);
   const [input, setInput] = useState("");
+  // Session id assigned by the backend, so follow-up answers continue the same diagnosis
+  const sessionId = useRef(null);
 
   // Send a greeting message when the application starts
   useEffect(() => {
@@ -28,7 +30,12 @@ function App() {
     console.log(response);
     
     try {
-      const response = await axios.post("https://car-chatbot-production.up.railway.app/api/chat", { message: input });
+      const response = await axios.post(
+        "https://car-chatbot-production.up.railway.app/api/chat",
+        { message: input },
+        { headers: sessionId.current ? { "X-Session-Id": sessionId.current } : {} }
+      );
+      sessionId.current = response.headers["x-session-id"] || sessionId.current;
       const botMessage = { sender: "Chatbot", text: response.data.response };
       const botLogData = {
         timestamp: new Date().toISOString(), // Generar un timestamp
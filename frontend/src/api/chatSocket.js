@@ -0,0 +1,92 @@
+// Keeps one WebSocket to /api/ws/chat open for the whole conversation, so
+// every message reuses the connection and the session held by the server.
+// Messages are answered with the same events as /api/chat/stream.
+
+// Rejects a turn whose connection dropped: the server ends the session with
+// the connection, so the conversation starts over on the next message
+export class ConnectionLost extends Error {
+  constructor() {
+    super("The connection to the chat server was lost");
+    this.name = "ConnectionLost";
+  }
+}
+
+export class ChatSocket {
+  constructor(baseUrl) {
+    this.url = `${baseUrl.replace(/^http/, "ws")}/api/ws/chat`;
+    this.socket = null;
+    this.onEvent = null;
+    // Called before the first turn on a new connection when an idle one dropped
+    this.onSessionEnded = null;
+    this.failTurn = null;
+    this.sessionLost = false;
+  }
+
+  connect() {
+    if (this.socket && this.socket.readyState <= WebSocket.OPEN) {
+      return this.ready;
+    }
+    const socket = new WebSocket(this.url);
+    this.socket = socket;
+    this.ready = new Promise((resolve, reject) => {
+      socket.onopen = () => {
+        socket.opened = true;
+        resolve();
+      };
+      socket.onerror = () => reject(new Error("Could not connect to the chat server"));
+    });
+    socket.onclose = () => {
+      if (!socket.opened || socket.closing) return;
+      if (this.failTurn) {
+        this.failTurn(new ConnectionLost());
+      } else {
+        this.sessionLost = true;
+      }
+    };
+    socket.onmessage = (message) => {
+      const data = JSON.parse(message.data);
+      // Answer heartbeats so the server keeps the connection open
+      if (data.type === "ping") {
+        socket.send(JSON.stringify({ type: "pong" }));
+      } else if (this.onEvent && data.type !== "session") {
+        this.onEvent(data.type, data);
+      }
+    };
+    return this.ready;
+  }
+
+  // Sends a message and calls onEvent(event, data) for each reply event until "done".
+  // Rejects with ConnectionLost if the connection drops before then.
+  async send(message, onEvent) {
+    await this.connect();
+    if (this.sessionLost) {
+      this.sessionLost = false;
+      if (this.onSessionEnded) this.onSessionEnded();
+    }
+    return new Promise((resolve, reject) => {
+      const settle = () => {
+        this.onEvent = null;
+        this.failTurn = null;
+      };
+      this.onEvent = (event, data) => {
+        onEvent(event, data);
+        if (event === "done") {
+          settle();
+          resolve();
+        }
+      };
+      this.failTurn = (error) => {
+        settle();
+        reject(error);
+      };
+      this.socket.send(JSON.stringify({ type: "message", message }));
+    });
+  }
+
+  close() {
+    if (this.socket) {
+      this.socket.closing = true;
+      this.socket.close();
+    }
+  }
+}
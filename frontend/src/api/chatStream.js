@@ -0,0 +1,41 @@
+// Sends a chat message to /api/chat/stream and calls onEvent(event, data) for
+// every Server-Sent Event as it arrives: "question", "diagnostic" or "message"
+// first, then "probability", and finally "done" (or "error").
+// Resolves with the session id assigned by the backend.
+export async function streamChat(baseUrl, message, sessionId, onEvent) {
+  const response = await fetch(`${baseUrl}/api/chat/stream`, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      ...(sessionId ? { "X-Session-Id": sessionId } : {}),
+    },
+    body: JSON.stringify({ message }),
+  });
+  if (!response.ok) {
+    throw new Error(`Chat request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let end;
+    while ((end = buffer.indexOf("\n\n")) !== -1) {
+      const frame = buffer.slice(0, end);
+      buffer = buffer.slice(end + 2);
+      let event = "message";
+      let data = "";
+      for (const line of frame.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      onEvent(event, data ? JSON.parse(data) : {});
+    }
+  }
+  return response.headers.get("X-Session-Id") || sessionId;
+}
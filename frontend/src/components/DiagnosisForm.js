@@ -1,41 +1,70 @@
-import React, { useState, useEffect } from "react";
-import axios from "axios";
+import React, { useState, useEffect, useRef } from "react";
+import { ChatSocket, ConnectionLost } from "../api/chatSocket";
+import { streamChat } from "../api/chatStream";
 import "./DiagnosisForm.css";
 
+const SESSION_ENDED = "The connection to the server was lost, so the diagnosis started over. Please describe the issue again.";
+
 function DiagnosisForm() {
   const [messages, setMessages] = useState([]);
   const [userInput, setUserInput] = useState("");
+  // Session id assigned by the backend, so follow-up answers continue the same diagnosis
+  const sessionId = useRef(null);
+  // One WebSocket for the whole conversation; the server keeps its session while it is open
+  const socket = useRef(null);
 
   // Mensaje inicial del chatbot
   useEffect(() => {
     setMessages([
       { sender: "bot", text: "Welcome! Describe the issue with your car, and I'll help diagnose it." },
     ]);
+    socket.current = new ChatSocket("http://localhost:8000");
+    // El servidor borra la sesión al cerrarse la conexión, así que el diagnóstico empieza de nuevo
+    socket.current.onSessionEnded = () => {
+      setMessages((prev) => [
+        ...prev.slice(0, -2),
+        { sender: "bot", text: SESSION_ENDED },
+        ...prev.slice(-2),
+      ]);
+    };
+    return () => socket.current.close();
   }, []);
 
+  // Actualiza el último mensaje del bot a medida que llegan los eventos
+  const updateLastBotMessage = (update) => {
+    setMessages((prev) => [...prev.slice(0, -1), { ...prev[prev.length - 1], ...update }]);
+  };
+
   const sendMessage = async () => {
     if (!userInput) return;
 
-    // Agregar el mensaje del usuario al chat
-    setMessages((prev) => [...prev, { sender: "user", text: userInput }]);
-
-    try {
-      // Enviar el mensaje del usuario al backend
-      const response = await axios.post("http://localhost:8000/api/chat", {
-        message: userInput,
-      });
+    // Agregar el mensaje del usuario y un mensaje del bot que se completa con el stream
+    setMessages((prev) => [...prev, { sender: "user", text: userInput }, { sender: "bot", text: "..." }]);
 
-      // Obtener la respuesta del chatbot
-      const botResponse = response.data.response;
+    // La pregunta o el diagnóstico llegan primero; la probabilidad después
+    const onEvent = (event, data) => {
+      if (event === "probability") {
+        updateLastBotMessage({ probability: data.text });
+      } else if (event === "error") {
+        updateLastBotMessage({ text: "I'm sorry, an error occurred while processing your request." });
+      } else if (event !== "done") {
+        updateLastBotMessage({ text: data.text });
+      }
+    };
 
-      // Agregar la respuesta del chatbot al chat
-      setMessages((prev) => [...prev, { sender: "bot", text: botResponse }]);
+    try {
+      try {
+        await socket.current.send(userInput, onEvent);
+      } catch (error) {
+        if (error instanceof ConnectionLost) throw error;
+        // Sin WebSocket (p. ej. un proxy que no lo soporta) se usa el stream HTTP
+        sessionId.current = await streamChat("http://localhost:8000", userInput, sessionId.current, onEvent);
+      }
     } catch (error) {
       console.error("Error communicating with the chatbot:", error);
-      setMessages((prev) => [
-        ...prev,
-        { sender: "bot", text: "I'm sorry, an error occurred while processing your request." },
-      ]);
+      updateLastBotMessage({
+        text: error instanceof ConnectionLost ? SESSION_ENDED : "I'm sorry, an error occurred while processing your request.",
+      });
     }
 
     // Limpiar la entrada del usuario
@@ -53,6 +82,7 @@ function DiagnosisForm() {
               msg.sender === "user" ? "user-message" : "bot-message"
             }`}
           >
+            {msg.probability && <div className="probability-note">{msg.probability}</div>}
             {msg.text}
           </div>
         ))}